@@ -1,15 +1,31 @@
+import sys
 import itertools
+from src.batch import BatchWriter, ingest
+from src.cache import ResponseCache
 from src.datasets import load_dataset
+from src.documents import load_document_store
 from src.models import load_model
 from src.run import run
 
-model = load_model('openai')
+cache = ResponseCache('cache/responses.sqlite')
+model = load_model('openai', cache=cache, stream=True)
+
+# batch mode as in baseline_vs_reprompt.py
+mode = sys.argv[1] if len(sys.argv) > 1 else 'run'
+batch_path = 'batch/analysis/gpt4/requests.jsonl'
+if mode == 'ingest':
+	print(ingest(model, batch_path, sys.argv[2:]))
+	sys.exit()
+batch_file = BatchWriter(batch_path) if mode == 'plan' \
+	else None
 
 dataset_names = ['nq', 'squad', 'hotpotqa', 'pubmed']
 context_lens = [40000]
 
 for dataset_name in dataset_names:
 	dataset = load_dataset(dataset_name)
+	# documents rendered beforehand with `python -m src.documents` are read instead of rebuilt
+	document_store = load_document_store(dataset_name, model.model_name)
 	question_ids = range(250) if dataset_name == 'hotpotqa' else range(50)
 	for context_len in context_lens:
 		answer_positions = range(0, context_len+1, 10000)
@@ -19,30 +35,33 @@ for dataset_name in dataset_names:
 			print(f'{dataset_name} {context_len//1000:d}k q{question_id} a{answer_position}')
 
 			print('reprompt 5k')
-			out = run(model, dataset, question_id=question_id, answer_position=answer_position, total_context=context_len, repeat_prompt=True, repeat_interval=5000, return_page=True, output_path=f'results/analysis/reprompt_tuning/{dataset_name}/gpt4/c{context_len:d}/5k/q{question_id:d}/a{answer_position:d}.json')
+			out = run(model, dataset, batch_file=batch_file, document_store=document_store, question_id=question_id, answer_position=answer_position, total_context=context_len, repeat_prompt=True, repeat_interval=5000, return_page=True, output_path=f'results/analysis/reprompt_tuning/{dataset_name}/gpt4/c{context_len:d}/5k/q{question_id:d}/a{answer_position:d}.json')
 
 			print('reprompt 20k')
-			out = run(model, dataset, question_id=question_id, answer_position=answer_position, total_context=context_len, repeat_prompt=True, repeat_interval=20000, return_page=True, output_path=f'results/analysis/reprompt_tuning/{dataset_name}/gpt4/c{context_len:d}/20k/q{question_id:d}/a{answer_position:d}.json')
+			out = run(model, dataset, batch_file=batch_file, document_store=document_store, question_id=question_id, answer_position=answer_position, total_context=context_len, repeat_prompt=True, repeat_interval=20000, return_page=True, output_path=f'results/analysis/reprompt_tuning/{dataset_name}/gpt4/c{context_len:d}/20k/q{question_id:d}/a{answer_position:d}.json')
 
 
 			print('repeat before answer')
-			out = run(model, dataset, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, repeat_prompt=True, repeat_interval=10000, repeat_before_answer=True, output_path=f'results/analysis/reprompt_mechanism/{dataset_name}/gpt4/c{context_len:d}/repeat-before-answer/q{question_id:d}/a{answer_position:d}.json')
+			out = run(model, dataset, batch_file=batch_file, document_store=document_store, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, repeat_prompt=True, repeat_interval=10000, repeat_before_answer=True, output_path=f'results/analysis/reprompt_mechanism/{dataset_name}/gpt4/c{context_len:d}/repeat-before-answer/q{question_id:d}/a{answer_position:d}.json')
 
 			print('repeat at beginning')
-			out = run(model, dataset, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, repeat_prompt=True, repeat_interval=10000, repeat_at_beginning=True, output_path=f'results/analysis/reprompt_mechanism/{dataset_name}/gpt4/c{context_len:d}/repeat-at-beginning/q{question_id:d}/a{answer_position:d}.json')
+			out = run(model, dataset, batch_file=batch_file, document_store=document_store, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, repeat_prompt=True, repeat_interval=10000, repeat_at_beginning=True, output_path=f'results/analysis/reprompt_mechanism/{dataset_name}/gpt4/c{context_len:d}/repeat-at-beginning/q{question_id:d}/a{answer_position:d}.json')
 
 			print('repeat tag only')
-			out = run(model, dataset, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, repeat_prompt=True, repeat_interval=10000, repeat_tag_only=True, output_path=f'results/analysis/reprompt_mechanism/{dataset_name}/gpt4/c{context_len:d}/repeat-tag-only/q{question_id:d}/a{answer_position:d}.json')
+			out = run(model, dataset, batch_file=batch_file, document_store=document_store, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, repeat_prompt=True, repeat_interval=10000, repeat_tag_only=True, output_path=f'results/analysis/reprompt_mechanism/{dataset_name}/gpt4/c{context_len:d}/repeat-tag-only/q{question_id:d}/a{answer_position:d}.json')
 
 
 			if dataset_name in ['nq', 'hotpotqa']:
 				continue
 
 			print('answer only')
-			out = run(model, dataset, question_id=question_id, answer_position=answer_position, total_context=context_len, output_path=f'results/analysis/page_retrieval/{dataset_name}/gpt4/c{context_len:d}/answer-only/q{question_id:d}/a{answer_position:d}.json')
+			out = run(model, dataset, batch_file=batch_file, document_store=document_store, question_id=question_id, answer_position=answer_position, total_context=context_len, output_path=f'results/analysis/page_retrieval/{dataset_name}/gpt4/c{context_len:d}/answer-only/q{question_id:d}/a{answer_position:d}.json')
 
 			print('page only')
-			out = run(model, dataset, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page_only=True, output_path=f'results/analysis/page_retrieval/{dataset_name}/gpt4/c{context_len:d}/page-only/q{question_id:d}/a{answer_position:d}.json')
+			out = run(model, dataset, batch_file=batch_file, document_store=document_store, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page_only=True, output_path=f'results/analysis/page_retrieval/{dataset_name}/gpt4/c{context_len:d}/page-only/q{question_id:d}/a{answer_position:d}.json')
 
 
+if batch_file is not None:
+	print(f'{len(batch_file):d} requests written to {batch_path}')
+print(cache.stats())
 print('done!')
@@ -1,10 +1,15 @@
+import sys
 import json
 import pathlib
 import itertools
 from anthropic import BadRequestError
+from src.batch import BatchWriter, ingest
+from src.cache import ResponseCache
 from src.datasets import load_dataset
+from src.documents import load_document_store
 from src.models import load_model
 from src.run import run
+from src.telemetry import Telemetry
 
 def saferun(*args, **kwargs):
 	try:
@@ -16,37 +21,73 @@ def saferun(*args, **kwargs):
 			with open(kwargs['output_path'], 'w') as f:
 				json.dump(out, f, indent=2)
 		return None
-	except:
+	except Exception as e:
+		print(f'failed: {e!r}')
 		return None
+	finally:
+		telemetry.advance()
 
 
+cache = ResponseCache('cache/responses.sqlite')
+
+# `tail -f` this file to follow throughput, latency, errors, cost and ETA while the sweep runs
+telemetry = Telemetry('results/telemetry/baseline_vs_reprompt.json', interval=10)
+
 model_name = 'gpt4'
 if model_name == 'gpt4':
-	model = load_model('openai')
+	model = load_model('openai', cache=cache, stream=True, telemetry=telemetry)
 if model_name == 'claude':
-	model = load_model('anthropic')
+	model = load_model('anthropic', cache=cache, stream=True, telemetry=telemetry)
+
+# `plan` writes the requests of the next step of every run to a batch file instead of calling the API,
+# and `ingest [results files]` loads the batch results into the cache; repeat until nothing is planned
+mode = sys.argv[1] if len(sys.argv) > 1 else 'run'
+batch_path = f'batch/baseline_vs_reprompt/{model_name}/requests.jsonl'
+if mode == 'ingest':
+	print(ingest(model, batch_path, sys.argv[2:]))
+	sys.exit()
+batch_file = BatchWriter(batch_path) if mode == 'plan' \
+	else None
 
 dataset_names = ['nq', 'squad', 'hotpotqa', 'pubmed']
 context_lens = [10000, 20000, 40000, 80000]
 
+# 'document_first' lets the provider cache the document shared by consecutive prompts (see src/prompts.py);
+# the loops below are ordered so that prompts sharing a prefix run back-to-back either way
+layout = 'instructions_first'
+results_dir = 'results/baseline_vs_reprompt' if layout == 'instructions_first' \
+	else f'results/baseline_vs_reprompt_{layout}'
+
+# number of runs in the grid below, for the ETA
+telemetry.total = sum((250 if dataset_name == 'hotpotqa' else 50) * (1 if dataset_name == 'hotpotqa' else context_len//10000 + 1) * (1 if context_len <= 10000 else 2) for dataset_name in dataset_names for context_len in context_lens)
+telemetry.start()
+
 for dataset_name in dataset_names:
 	dataset = load_dataset(dataset_name)
+	# documents rendered beforehand with `python -m src.documents` are read instead of rebuilt
+	document_store = load_document_store(dataset_name, model.model_name)
 	question_ids = range(250) if dataset_name == 'hotpotqa' else range(50)
-	for context_len in context_lens:
-		answer_positions = range(0, context_len+1, 10000)
-		for (question_id, answer_position) in itertools.product(question_ids, answer_positions):
-			if answer_position > 0 and dataset_name == 'hotpotqa':
-				continue
-			print(f'{dataset_name} {context_len//1000:d}k q{question_id} a{answer_position}')
+	answer_positions = range(0, max(context_lens)+1, 10000)
+	# a shorter context is a prefix of a longer one with the same question and answer position
+	for (question_id, answer_position, context_len) in itertools.product(question_ids, answer_positions, context_lens):
+		if answer_position > context_len:
+			continue
+		if answer_position > 0 and dataset_name == 'hotpotqa':
+			continue
+		print(f'{dataset_name} {context_len//1000:d}k q{question_id} a{answer_position}')
 
-			print('baseline')
-			out = saferun(model, dataset, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, output_path=f'results/baseline_vs_reprompt/{dataset_name}/{model_name}/c{context_len:d}/baseline/q{question_id:d}/a{answer_position:d}.json')
+		print('baseline')
+		out = saferun(model, dataset, batch_file=batch_file, document_store=document_store, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, layout=layout, output_path=f'{results_dir}/{dataset_name}/{model_name}/c{context_len:d}/baseline/q{question_id:d}/a{answer_position:d}.json')
 
-			if context_len <= 10000:
-				continue
+		if context_len <= 10000:
+			continue
 
-			print('reprompt')
-			out = saferun(model, dataset, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, repeat_prompt=True, repeat_interval=10000, output_path=f'results/baseline_vs_reprompt/{dataset_name}/{model_name}/c{context_len:d}/reprompt/q{question_id:d}/a{answer_position:d}.json')
+		print('reprompt')
+		out = saferun(model, dataset, batch_file=batch_file, document_store=document_store, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, repeat_prompt=True, repeat_interval=10000, layout=layout, output_path=f'{results_dir}/{dataset_name}/{model_name}/c{context_len:d}/reprompt/q{question_id:d}/a{answer_position:d}.json')
 
 
+if batch_file is not None:
+	print(f'{len(batch_file):d} requests written to {batch_path}')
+print(telemetry.stop())
+print(cache.stats())
 print('done!')
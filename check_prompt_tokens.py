@@ -0,0 +1,58 @@
+import argparse
+from src.datasets import load_dataset
+from src.models import load_model
+from src.parsers import page_index, split_pages
+from src.prompts import LAYOUTS, Prompt, get_answer, get_page_numbers_only
+
+### check the token counts prompts add up from their parts against encoding the whole prompt
+
+parser = argparse.ArgumentParser(description='Check Prompt.tokens against the exact count of the assembled prompt, for every reprompt mode and layout.')
+parser.add_argument('--model', choices=['openai', 'anthropic', 'mock'], default='mock', help='whose tokenizer to check with')
+parser.add_argument('--dataset', default='synthetic')
+parser.add_argument('--questions', type=int, default=3)
+parser.add_argument('--context-lens', type=int, nargs='+', default=[10000, 40000])
+args = parser.parse_args()
+
+model = load_model(args.model)
+dataset = load_dataset(args.dataset)
+
+# the ways run_steps builds an answer prompt, as get_answer kwargs
+modes = {
+	'baseline': {},
+	'return-page': {'return_page': True},
+	'reprompt': {'repeat_prompt': True, 'repeat_interval': 5000, 'return_page': True},
+	'repeat-at-beginning': {'repeat_prompt': True, 'repeat_interval': 5000, 'repeat_at_beginning': True},
+	'repeat-tag-only': {'repeat_prompt': True, 'repeat_interval': 5000, 'repeat_tag_only': True}
+}
+
+checked = 0
+for question_id in range(args.questions):
+	for total_context in args.context_lens:
+		example = dataset.get(question_id=question_id, answer_position=total_context//2, total_context=total_context, get_tokens_batch=model.get_tokens_batch)
+		question = example['question']
+		document = example['document']
+		gold_pages = example['pages'] if 'pages' in example else [example['page']]
+		page_tokens = model.get_tokens_batch(split_pages(document))
+		# an abbreviated document, as run_steps makes it from the extracted pages
+		index = page_index(document)
+		abbreviated = '\n\n'.join(filter(lambda p: len(p)>0, [index.page(p) for p in gold_pages + [1, 2]]))
+
+		prompts = []
+		for layout in LAYOUTS:
+			for name, kwargs in modes.items():
+				prompts.append((name, layout, get_answer(question, document, model.get_tokens_batch, layout=layout, **kwargs)))
+				prompts.append((f'{name} (page tokens given)', layout, get_answer(question, document, model.get_tokens_batch, layout=layout, page_tokens=page_tokens, **kwargs)))
+				prompts.append((f'{name} (abbreviated)', layout, get_answer(question, abbreviated, model.get_tokens_batch, layout=layout, **kwargs)))
+			prompts.append(('repeat-before-answer', layout, get_answer(question, document, model.get_tokens_batch, repeat_before_pages=gold_pages, layout=layout)))
+			for repeat_prompt in [False, True]:
+				for questions in [[question], [question, question + ' (rephrased)']]:
+					prompts.append((f'page numbers ({len(questions):d} questions, repeat_prompt={repeat_prompt})', layout, \
+						get_page_numbers_only(questions, document, model.get_tokens_batch, repeat_prompt=repeat_prompt, repeat_interval=5000, layout=layout, page_tokens=page_tokens)))
+
+		for name, layout, prompt in prompts:
+			assert isinstance(prompt, Prompt), f'{name}, {layout}: not a Prompt'
+			exact = model.get_tokens(str(prompt))
+			assert prompt.tokens == exact, f'q{question_id:d} c{total_context:d} {name}, {layout}: {prompt.tokens:d} tokens counted from the parts, {exact:d} exactly'
+			checked += 1
+
+print(f'OK: {checked:d} prompts counted exactly with {model.model_name}')
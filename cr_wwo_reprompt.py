@@ -1,10 +1,15 @@
+import sys
 import json
 import pathlib
 import itertools
 from anthropic import BadRequestError
+from src.batch import BatchWriter, ingest
+from src.cache import ResponseCache
 from src.datasets import load_dataset
+from src.documents import load_document_store
 from src.models import load_model
 from src.run import run
+from src.telemetry import Telemetry
 
 def saferun(*args, **kwargs):
 	try:
@@ -16,22 +21,52 @@ def saferun(*args, **kwargs):
 			with open(kwargs['output_path'], 'w') as f:
 				json.dump(out, f, indent=2)
 		return None
-	except:
+	except Exception as e:
+		print(f'failed: {e!r}')
 		return None
+	finally:
+		telemetry.advance()
 
 
+cache = ResponseCache('cache/responses.sqlite')
+
+# `tail -f` this file to follow throughput, latency, errors, cost and ETA while the sweep runs
+telemetry = Telemetry('results/telemetry/cr_wwo_reprompt.json', interval=10)
+
 model_name = 'gpt4'
 if model_name == 'gpt4':
-	model = load_model('openai')
+	model = load_model('openai', cache=cache, stream=True, telemetry=telemetry)
 if model_name == 'claude':
-	model = load_model('anthropic')
+	model = load_model('anthropic', cache=cache, stream=True, telemetry=telemetry)
+
+# `plan` writes the requests of the next step of every run to a batch file instead of calling the API,
+# and `ingest [results files]` loads the batch results into the cache; repeat until nothing is planned
+mode = sys.argv[1] if len(sys.argv) > 1 else 'run'
+batch_path = f'batch/cr_wwo_reprompt/{model_name}/requests.jsonl'
+if mode == 'ingest':
+	print(ingest(model, batch_path, sys.argv[2:]))
+	sys.exit()
+batch_file = BatchWriter(batch_path) if mode == 'plan' \
+	else None
 
 dataset_names = ['nq', 'squad', 'hotpotqa', 'pubmed']
 context_len = 80000
 answer_positions = range(0, context_len+1, 10000)
 
+# 'document_first' lets the provider cache the chunks shared by consecutive prompts (see src/prompts.py),
+# e.g. those of a chunk size with and without reprompting, up to the first reminder
+layout = 'instructions_first'
+results_dir = 'results/cvr' if layout == 'instructions_first' \
+	else f'results/cvr_{layout}'
+
+# number of runs in the grid below, for the ETA
+telemetry.total = sum((250 if dataset_name == 'hotpotqa' else 50) * (1 if dataset_name == 'hotpotqa' else len(answer_positions)) * 7 for dataset_name in dataset_names)
+telemetry.start()
+
 for dataset_name in dataset_names:
 	dataset = load_dataset(dataset_name)
+	# documents rendered beforehand with `python -m src.documents` are read instead of rebuilt
+	document_store = load_document_store(dataset_name, model.model_name)
 	question_ids = range(250) if dataset_name == 'hotpotqa' else range(50)
 	for (question_id, answer_position) in itertools.product(question_ids, answer_positions):
 		if answer_position > 0 and dataset_name == 'hotpotqa':
@@ -40,16 +75,20 @@ for dataset_name in dataset_names:
 		for cs in [10, 20, 40, 80]:
 
 			print(f'CR {cs:d}k')
-			out = saferun(model, dataset, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, do_abbreviate=True, do_chunking=True, chunk_size=cs*1000, output_path=f'results/cvr/{dataset_name}/{model_name}/c{context_len:d}/cr{cs:d}k/q{question_id:d}/a{answer_position:d}.json')
+			out = saferun(model, dataset, batch_file=batch_file, document_store=document_store, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, do_abbreviate=True, do_chunking=True, chunk_size=cs*1000, layout=layout, output_path=f'{results_dir}/{dataset_name}/{model_name}/c{context_len:d}/cr{cs:d}k/q{question_id:d}/a{answer_position:d}.json')
 
 			if cs == 10:
 				continue
 
 			print(f'CR {cs:d}k + Reprompt')
 			if cs == 80:
-				out = saferun(model, dataset, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, repeat_prompt=True, repeat_interval=10000, do_abbreviate=True, output_path=f'results/cvr/{dataset_name}/{model_name}/c{context_len:d}/cr80k+reprompt/q{question_id:d}/a{answer_position:d}.json')
+				out = saferun(model, dataset, batch_file=batch_file, document_store=document_store, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, repeat_prompt=True, repeat_interval=10000, do_abbreviate=True, layout=layout, output_path=f'{results_dir}/{dataset_name}/{model_name}/c{context_len:d}/cr80k+reprompt/q{question_id:d}/a{answer_position:d}.json')
 			else:
-				out = saferun(model, dataset, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, repeat_prompt=True, repeat_interval=10000, do_abbreviate=True, do_chunking=True, chunk_size=cs*1000, output_path=f'results/cvr/{dataset_name}/{model_name}/c{context_len:d}/cr{cs:d}k+reprompt/q{question_id:d}/a{answer_position:d}.json')
+				out = saferun(model, dataset, batch_file=batch_file, document_store=document_store, question_id=question_id, answer_position=answer_position, total_context=context_len, return_page=True, repeat_prompt=True, repeat_interval=10000, do_abbreviate=True, do_chunking=True, chunk_size=cs*1000, layout=layout, output_path=f'{results_dir}/{dataset_name}/{model_name}/c{context_len:d}/cr{cs:d}k+reprompt/q{question_id:d}/a{answer_position:d}.json')
 
 
+if batch_file is not None:
+	print(f'{len(batch_file):d} requests written to {batch_path}')
+print(telemetry.stop())
+print(cache.stats())
 print('done!')
@@ -13,4 +13,8 @@ wget -P data/squad https://rajpurkar.github.io/SQuAD-explorer/dataset/train-v2.0
 echo Downloading HotPotQA . . .
 wget -P data/hotpotqa http://curtis.ml.cmu.edu/datasets/hotpot/hotpot_train_v1.1.json
 
+# build the record stores and filler arenas once, rather than on the first run
+echo Indexing . . .
+python -c "from src.datasets import load_dataset; [load_dataset(d) for d in ['nq', 'squad', 'hotpotqa']]"
+
 echo Done!
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+import numpy as np
+from src.datasets import load_dataset
+from src.models import load_model
+from src.run import run, run_async
+
+### drive a baseline/reprompt/R&R sweep through a mock backend and measure the pipeline itself
+
+parser = argparse.ArgumentParser(description='Load test the R&R pipeline against a mock LLM backend.')
+parser.add_argument('--backend', choices=['mock', 'server'], default='mock', help='in-process MockModel, or OpenAIModel against a local mock server')
+parser.add_argument('--env', default='configs/openai.env', help='env file for the server backend (MODEL_NAME is used for tokenization)')
+parser.add_argument('--port', type=int, default=8765)
+parser.add_argument('--dataset', default='synthetic')
+parser.add_argument('--questions', type=int, default=5)
+parser.add_argument('--context-lens', type=int, nargs='+', default=[10000, 20000, 40000, 80000])
+parser.add_argument('--concurrency', type=int, default=32)
+parser.add_argument('--sync', action='store_true', help='use run instead of run_async')
+parser.add_argument('--layout', choices=['instructions_first', 'document_first'], default='instructions_first')
+parser.add_argument('--latency', type=float, default=1.0, help='median latency in seconds')
+parser.add_argument('--latency-sigma', type=float, default=0.5)
+parser.add_argument('--error-rate', type=float, default=0)
+parser.add_argument('--rate-limit-rate', type=float, default=0)
+args = parser.parse_args()
+
+mock_args = {'latency': args.latency, 'latency_sigma': args.latency_sigma, 'error_rate': args.error_rate, 'rate_limit_rate': args.rate_limit_rate}
+
+server = None
+if args.backend == 'server':
+	server = subprocess.Popen([sys.executable, '-m', 'src.mock_server', '--port', str(args.port)] + [f'--{k.replace("_", "-")}={v}' for k, v in mock_args.items()])
+	while True:
+		try:
+			socket.create_connection(('127.0.0.1', args.port)).close()
+			break
+		except OSError:
+			time.sleep(0.1)
+	os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{args.port:d}/v1'
+	os.environ.setdefault('OPENAI_API_KEY', 'mock')
+	model = load_model('openai', path_to_env=args.env, max_concurrency=args.concurrency, pool_size=args.concurrency)
+else:
+	model = load_model('mock', max_concurrency=args.concurrency, **mock_args)
+
+dataset = load_dataset(args.dataset)
+
+# per-request latencies, measured around the model's public entry point
+latencies = []
+get_response = model.get_response
+def timed_get_response(*args, **kwargs):
+	start = time.perf_counter()
+	try:
+		return get_response(*args, **kwargs)
+	finally:
+		latencies.append(time.perf_counter() - start)
+model.get_response = timed_get_response
+
+# the configs of baseline_vs_reprompt.py and cr_wwo_reprompt.py, without writing results
+configs = []
+for question_id in range(args.questions):
+	for answer_position in range(0, max(args.context_lens)+1, 10000):
+		for context_len in [c for c in args.context_lens if c >= answer_position]:
+			common = {'question_id': question_id, 'answer_position': answer_position, 'total_context': context_len, 'return_page': True, 'layout': args.layout}
+			configs.append(dict(common))
+			configs.append(dict(common, repeat_prompt=True, repeat_interval=10000))
+			configs.append(dict(common, do_abbreviate=True, do_chunking=True, chunk_size=10000))
+
+
+async def run_all():
+	async def saferun(config):
+		try:
+			return await run_async(model, dataset, **config)
+		except Exception:
+			return None
+	return await asyncio.gather(*[saferun(config) for config in configs])
+
+start_cpu = time.process_time()
+start_time = time.perf_counter()
+
+if args.sync:
+	outs = []
+	for config in configs:
+		try:
+			outs.append(run(model, dataset, **config))
+		except Exception:
+			outs.append(None)
+else:
+	outs = asyncio.run(run_all())
+
+wall_time = time.perf_counter() - start_time
+cpu_time = time.process_time() - start_cpu
+
+if server is not None:
+	server.terminate()
+
+report = {
+	'runs': len(configs),
+	'failed_runs': sum(out is None for out in outs),
+	'requests': len(latencies),
+	'wall_time': wall_time,
+	'runs_per_second': len(configs)/wall_time,
+	'requests_per_second': len(latencies)/wall_time,
+	'cpu_ms_per_request': 1000*cpu_time/max(len(latencies), 1),
+	'latency_p50': float(np.percentile(latencies, 50)) if latencies else None,
+	'latency_p95': float(np.percentile(latencies, 95)) if latencies else None,
+	'latency_p99': float(np.percentile(latencies, 99)) if latencies else None,
+	'input_tokens': model.input_tokens,
+	'output_tokens': model.output_tokens,
+	'cached_input_tokens': model.cached_input_tokens
+}
+
+print(json.dumps(report, indent=2))
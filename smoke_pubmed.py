@@ -0,0 +1,37 @@
+import os
+import json
+import random
+import tempfile
+import argparse
+from src.datasets import PubMed
+
+### run both PubMed build steps end to end against the mock backend, on a small generated input
+
+parser = argparse.ArgumentParser(description='Smoke test PubMed.collect_abstracts and PubMed.generate_questions with MockModel.')
+parser.add_argument('--abstracts', type=int, default=200, help='lines of generated input')
+parser.add_argument('--questions', type=int, default=10)
+parser.add_argument('--workers', type=int, default=2)
+args = parser.parse_args()
+
+rng = random.Random(0)
+words = ['protein', 'cell', 'gene', 'expression', 'patients', 'significantly', 'increased', 'the', 'of', 'and', 'in', 'with']
+
+with tempfile.TemporaryDirectory() as path:
+	# PMID<TAB>abstract, with lengths on both sides of the token limits
+	input_file = os.path.join(path, 'abstracts.tsv')
+	with open(input_file, 'w') as f:
+		for i in range(args.abstracts):
+			f.write(f'{i:d}\t"' + ' '.join(rng.choice(words) for _ in range(rng.randint(100, 250))) + '."\n')
+
+	pm = PubMed(input_file=input_file, output_dir=os.path.join(path, 'pubmed'))
+	pm.collect_abstracts(model_cls='mock', num_workers=args.workers, chunk_size=50)
+	with open(os.path.join(pm.output_dir, 'abstracts.json'), 'r') as f:
+		abstracts = json.load(f)
+	assert len(abstracts) >= args.questions, f'only {len(abstracts):d} abstracts were kept'
+
+	pm.generate_questions(num_questions=args.questions, model_cls='mock')
+	with open(os.path.join(pm.output_dir, 'questions.json'), 'r') as f:
+		questions = json.load(f)
+	assert len(questions) == args.questions, f'{len(questions):d} questions instead of {args.questions:d}'
+
+print(f'OK: {len(abstracts):d} abstracts kept, {len(questions):d} questions generated')
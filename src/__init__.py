@@ -1,6 +1,13 @@
+from . import arena
+from . import batch
+from . import cache
 from . import datasets
+from . import documents
 from . import metrics
+from . import mock_server
 from . import models
 from . import parsers
 from . import prompts
 from . import run
+from . import store
+from . import telemetry
@@ -0,0 +1,110 @@
+import os
+import threading
+import numpy as np
+from .store import finish_build, start_build
+
+### filler arena
+# every filler paragraph of a dataset in one UTF-8 buffer, with byte offsets, a group ID per paragraph
+# (e.g. its SQuAD topic or NQ question) and the token counts of its page text, all saved under `path`
+# and memory-mapped, so the filler of a question is an array of paragraph IDs rather than a list of
+# strings, and parallel workers share the same pages of the OS cache instead of copies of the dataset
+
+PAGE_TEMPLATE = '\n<PAGE {{PAGE}}>\n{text}\n</PAGE {{PAGE}}>\n'
+
+
+class FillerArena(object):
+
+	def __init__(self, path):
+		self.path = path
+		self.offsets = np.load(os.path.join(self.path, 'offsets.npy'), mmap_mode='r')
+		self.groups = np.load(os.path.join(self.path, 'groups.npy'), mmap_mode='r')
+		self.buffer = np.memmap(os.path.join(self.path, 'text.bin'), dtype=np.uint8, mode='r') if self.offsets[-1] > 0 \
+			else np.zeros(0, dtype=np.uint8)
+
+		self._tokens = {}
+		self._tokens_lock = threading.Lock()
+
+
+	@classmethod
+	def build(cls, path, texts, groups, source=None):
+		tmp_path = start_build(path)
+
+		offsets = [0]
+		with open(os.path.join(tmp_path, 'text.bin'), 'wb') as f:
+			for text in texts:
+				data = text.encode('utf-8')
+				f.write(data)
+				offsets.append(offsets[-1] + len(data))
+		np.save(os.path.join(tmp_path, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+		np.save(os.path.join(tmp_path, 'groups.npy'), np.array(groups, dtype=np.int64))
+
+		finish_build(tmp_path, path, source)
+		return cls(path)
+
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+
+	def text(self, i):
+		return bytes(self.buffer[self.offsets[i]:self.offsets[i+1]]).decode('utf-8')
+
+
+	def tokens(self, get_tokens_batch, n=None):
+		# token counts of the first `n` (by default all) page texts, computed a block at a time as they are
+		# needed and saved next to the text if we know which model the tokenizer belongs to
+		model_name = getattr(getattr(get_tokens_batch, '__self__', None), 'model_name', None)
+		key = model_name or id(get_tokens_batch)
+		n = len(self) if n is None else n
+		with self._tokens_lock:
+			if key not in self._tokens:
+				tokens_path = os.path.join(self.path, f'tokens-{model_name}.npy')
+				tokens = np.load(tokens_path) if model_name is not None and os.path.exists(tokens_path) else None
+				if tokens is None or len(tokens) != len(self):
+					tokens = np.full(len(self), -1, dtype=np.int64)
+				# counts are filled in from the start, and -1 marks those not computed yet
+				computed = int(np.argmax(tokens < 0)) if (tokens < 0).any() else len(self)
+				self._tokens[key] = [tokens, computed]
+
+			tokens, computed = self._tokens[key]
+			if computed < n:
+				for i in range(computed, n, 4096):
+					texts = [PAGE_TEMPLATE.format(text=self.text(j)) for j in range(i, min(i+4096, len(self)))]
+					tokens[i:i+len(texts)] = get_tokens_batch(texts)
+				self._tokens[key][1] = computed = min(len(self), i+4096)
+				if model_name is not None:
+					tokens_path = os.path.join(self.path, f'tokens-{model_name}.npy')
+					np.save(f'{tokens_path}.{os.getpid():d}.tmp.npy', tokens)
+					os.replace(f'{tokens_path}.{os.getpid():d}.tmp.npy', tokens_path)
+
+			return tokens[:n]
+
+
+	def exclude(self, group):
+		return ArenaView(self, np.flatnonzero(self.groups != group))
+
+	def select(self, group):
+		return ArenaView(self, np.flatnonzero(self.groups == group))
+
+
+
+class ArenaView(object):
+
+	# the paragraphs `ids` of an arena, in order
+	def __init__(self, arena, ids):
+		self.arena = arena
+		self.ids = ids
+
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __getitem__(self, i):
+		return self.arena.text(self.ids[i])
+
+	def tokens(self, get_tokens_batch, n=None):
+		# token counts of the first `n` (by default all) paragraphs of the view
+		ids = self.ids if n is None else self.ids[:n]
+		if len(ids) == 0:
+			return np.zeros(0, dtype=np.int64)
+		return self.arena.tokens(get_tokens_batch, int(ids.max())+1)[ids]
@@ -0,0 +1,63 @@
+import json
+import pathlib
+
+### offline batch mode
+# a plan round runs every config with a BatchWriter: finished steps are replayed from the model's
+# response cache, and the first step with uncached requests is written to the batch file instead.
+# `ingest` then loads the provider's results into the cache, and the next plan round advances one
+# more step of each run (e.g. rephrasing, then page retrieval, then the answer).
+
+class BatchWriter(object):
+
+	def __init__(self, path):
+		self.path = path
+		self.custom_ids = set()
+
+		pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+		open(self.path, 'w').close()
+
+
+	def add_missing(self, model, requests):
+		# writes the requests missing from the cache and returns how many are missing
+		if model.cache is None:
+			raise ValueError('Batch mode needs a model with a response cache.')
+
+		missing = 0
+		with open(self.path, 'a') as f:
+			for request in requests:
+				# the cache key is a stable custom ID, so results can be stored under it as-is
+				custom_id = model.cache_key(request['query_text'], max_tokens=request.get('max_tokens', 4000), temperature=request.get('temperature', 0), words_in_mouth=request.get('words_in_mouth'))
+				if custom_id in model.cache:
+					continue
+				missing += 1
+				if custom_id in self.custom_ids:
+					continue
+				self.custom_ids.add(custom_id)
+				f.write(json.dumps(model.batch_request(custom_id, **request)) + '\n')
+
+		return missing
+
+
+	def __len__(self):
+		return len(self.custom_ids)
+
+
+
+def ingest(model, requests_path, results_paths):
+	# store the results of a submitted batch file in the model's response cache
+	with open(requests_path, 'r') as f:
+		requests = {r['custom_id']: r for r in map(json.loads, f)}
+
+	counts = {'succeeded': 0, 'failed': 0}
+	for results_path in results_paths:
+		with open(results_path, 'r') as f:
+			for l in f:
+				result = json.loads(l)
+				custom_id, out, input_tokens, output_tokens = model.parse_batch_result(result, requests[result['custom_id']])
+				if out is None:
+					counts['failed'] += 1
+					continue
+				model.cache.put(custom_id, out, input_tokens, output_tokens)
+				counts['succeeded'] += 1
+
+	return counts
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import pathlib
+import sqlite3
+import hashlib
+import threading
+
+
+class CacheMissError(LookupError):
+	pass
+
+
+
+class ResponseCache(object):
+
+	def __init__(self, path='cache/responses.sqlite', max_bytes=None, replay=False):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.replay = replay
+
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+
+		# replay mode opens the database read-only and treats a miss as an error
+		if self.replay:
+			if not os.path.exists(self.path):
+				raise ValueError(f'The file {self.path} does not exist.')
+			self._conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+		else:
+			pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+			self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=60)
+			self._conn.execute('PRAGMA journal_mode=WAL')
+			self._conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, input_tokens INTEGER, output_tokens INTEGER, size INTEGER, last_access REAL)')
+			self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+
+		self._bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+
+	@staticmethod
+	def make_key(model_name, query_text, max_tokens, temperature, words_in_mouth):
+		prompt_hash = hashlib.sha256(query_text.encode('utf-8')).hexdigest()
+		params = json.dumps([model_name, prompt_hash, max_tokens, temperature, words_in_mouth or ''])
+		return hashlib.sha256(params.encode('utf-8')).hexdigest()
+
+
+	def __contains__(self, key):
+		with self._lock:
+			row = self._conn.execute('SELECT 1 FROM responses WHERE key = ?', (key,)).fetchone()
+		return row is not None
+
+
+	def get(self, key):
+		with self._lock:
+			row = self._conn.execute('SELECT response, input_tokens, output_tokens FROM responses WHERE key = ?', (key,)).fetchone()
+
+			if row is None:
+				self.misses += 1
+				if self.replay:
+					raise CacheMissError(f'No cached response for key {key}.')
+				return None
+
+			self.hits += 1
+			if not self.replay:
+				self._conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+
+		out, input_tokens, output_tokens = row
+		return out, input_tokens, output_tokens
+
+
+	def put(self, key, out, input_tokens, output_tokens):
+		if self.replay:
+			return
+
+		size = len(key) + len(out.encode('utf-8'))
+		with self._lock:
+			old = self._conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+			self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', (key, out, input_tokens, output_tokens, size, time.time()))
+			self._bytes += size - (old[0] if old is not None else 0)
+			self._evict()
+
+		return
+
+
+	def _evict(self):
+		# drop least recently used entries until we are back under the size cap
+		while self.max_bytes is not None and self._bytes > self.max_bytes:
+			rows = self._conn.execute('SELECT key, size FROM responses ORDER BY last_access LIMIT 100').fetchall()
+			if len(rows) == 0:
+				break
+			for key, size in rows:
+				if self._bytes <= self.max_bytes:
+					break
+				self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+				self._bytes -= size
+		return
+
+
+	def stats(self):
+		with self._lock:
+			entries = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+			lookups = self.hits + self.misses
+
+			out = {
+				'hits': self.hits,
+				'misses': self.misses,
+				'hit_rate': self.hits/lookups if lookups > 0 else None,
+				'entries': entries,
+				'bytes': self._bytes
+			}
+
+		return out
+
+
+	def close(self):
+		with self._lock:
+			self._conn.close()
+		return
@@ -1,29 +1,30 @@
 import os
 import json
+import time
+import random
+import string
 import functools
+import threading
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
 from xopen import xopen
+from .arena import PAGE_TEMPLATE, ArenaView, FillerArena
 from .models import load_model
+from .store import RecordStore, is_built, source_id
 
 
 
 def paginate(func):
 
+	# wraps the context as a page; the filler, a list of paragraphs or an arena view,
+	# is paginated by FillerIndex as far as the documents asked for need it
 	def wrapper(*args, **kwargs):
-		get_tokens = kwargs['get_tokens']
+		get_tokens_batch = kwargs['get_tokens_batch']
 		question, answer, context, filler = func(*args, **kwargs)
 
 		context = {'text': '\n<PAGE {PAGE}>\n' + context + '\n</PAGE {PAGE}>\n'}
-		context['tokens'] = get_tokens(context['text'])
-
-		filler = [{'text': '\n<PAGE {PAGE}>\n' + f + '\n</PAGE {PAGE}>\n'} for f in filler]
-		count = 0
-		for f in filler:
-			f['tokens'] = get_tokens(f['text'])
-			count += f['tokens']
-			if count >= 100000:
-				break
-
-		filler = [f for f in filler if 'tokens' in f.keys()]
+		context['tokens'] = get_tokens_batch([context['text']])[0]
 
 		return question, answer, context, filler
 
@@ -31,6 +32,81 @@ def paginate(func):
 
 
 
+class FillerIndex(object):
+
+	# the filler pages of one question, with token counts and their prefix sums, from which the document
+	# for any answer position and context length is cut out with a binary search and a single join;
+	# pages are tokenized lazily, doubling the number of pages each time a document needs more
+	def __init__(self, context, filler, get_tokens_batch):
+		self.context = context
+		self.filler = filler
+		self.get_tokens_batch = get_tokens_batch
+
+		self.templates = []
+		self.tokens = np.zeros(0, dtype=np.int64)
+		self.cumsum = np.zeros(0, dtype=np.int64)
+		self._numbered = {1: [], 2: []}
+		self._lock = threading.Lock()
+
+
+	def grow(self, total):
+		# paginates filler until it adds up to `total` tokens or runs out
+		while (len(self.cumsum) == 0 or self.cumsum[-1] < total) and len(self.templates) < len(self.filler):
+			start = len(self.templates)
+			stop = min(len(self.filler), start + max(256, start))
+			if isinstance(self.filler, ArenaView):
+				texts = [PAGE_TEMPLATE.format(text=self.filler[i]) for i in range(start, stop)]
+				tokens = self.filler.tokens(self.get_tokens_batch, stop)[start:]
+			else:
+				texts = [PAGE_TEMPLATE.format(text=f) for f in self.filler[start:stop]]
+				tokens = np.array(self.get_tokens_batch(texts), dtype=np.int64)
+
+			offset = self.cumsum[-1] if len(self.cumsum) > 0 else 0
+			self.templates.extend(texts)
+			self.tokens = np.concatenate([self.tokens, tokens])
+			self.cumsum = np.concatenate([self.cumsum, offset + np.cumsum(tokens)])
+		return
+
+
+	def numbered(self, offset, n):
+		# the first `n` page texts numbered from `offset`, i.e. 1 before the answer page and 2 after it
+		numbered = self._numbered[offset]
+		numbered.extend(text.replace('{PAGE}', f'{i+offset:d}') for i, text in enumerate(self.templates[len(numbered):n], len(numbered)))
+		return numbered[:n]
+
+
+	def cut(self, answer_position, total_context):
+		# reproduces the page-by-page loop of LocalContextDataset.get: filler pages are added until their
+		# total reaches `answer_position`, then the answer page, then filler until `total_context` is reached;
+		# returns the filler page after which the answer goes (None if it is left out) and the last filler page
+		self.grow(max(answer_position, total_context))
+
+		if answer_position < 0:
+			end = int(np.searchsorted(self.cumsum, total_context))
+			return None, min(end, len(self.templates)-1)
+
+		k = int(np.searchsorted(self.cumsum, answer_position))
+		if k == len(self.templates) or (k > 0 and self.cumsum[k-1] >= total_context):
+			raise ValueError(f'Cannot place the answer at {answer_position:d} tokens in a context of {total_context:d}.')
+		end = max(k, int(np.searchsorted(self.cumsum, total_context - self.context['tokens'])))
+		return k, min(end, len(self.templates)-1)
+
+
+	def document(self, answer_position, total_context):
+		# returns the document and the page number of the answer
+		with self._lock:
+			k, end = self.cut(answer_position, total_context)
+			if k is None:
+				return ''.join(self.numbered(1, end+1)).strip(), None
+
+			before = self.numbered(1, k+1)
+			after = self.numbered(2, end+1)[k+1:]
+
+		context = self.context['text'].replace('{PAGE}', f'{k+2:d}')
+		return ''.join(before + [context] + after).strip(), k+2
+
+
+
 class LocalContextDataset(object):
 
 	def __init__(self):
@@ -39,38 +115,20 @@ class LocalContextDataset(object):
 
 	@functools.lru_cache(maxsize=1)
 	@paginate
-	def get_materials(self, question_id=0, get_tokens=None):
+	def get_materials(self, question_id=0, get_tokens_batch=None):
 		raise NotImplemented
 
 
 	@functools.lru_cache(maxsize=1)
-	def get(self, question_id=0, answer_position=0, total_context=100000, get_tokens=None):
-		# get raw materials
-		question, answer, context, filler = self.get_materials(question_id=question_id, get_tokens=get_tokens)
+	def get_index(self, question_id=0, get_tokens_batch=None):
+		question, answer, context, filler = self.get_materials(question_id=question_id, get_tokens_batch=get_tokens_batch)
+		return question, answer, FillerIndex(context, filler, get_tokens_batch)
 
-		page_counter = 1
-		total_len = 0
-		added = answer_position<0
 
-		# start creating document
-		document = ''
-		for junk in filler:
-
-			document += junk['text'].replace('{PAGE}', f'{page_counter:d}')
-			page_counter += 1
-			total_len += junk['tokens']
-		
-			# add the actual context containing the answer at `answer_position`
-			if total_len >= answer_position and not added:
-				added = True
-				document += context['text'].replace('{PAGE}', f'{page_counter:d}')
-				page_num = page_counter
-				page_counter += 1
-				total_len += context['tokens']
-		
-			# don't exceed the `total_context` defined
-			if total_len >= total_context:
-				break
+	@functools.lru_cache(maxsize=1)
+	def get(self, question_id=0, answer_position=0, total_context=100000, get_tokens_batch=None):
+		question, answer, index = self.get_index(question_id=question_id, get_tokens_batch=get_tokens_batch)
+		document, page_num = index.document(answer_position, total_context)
 
 		# if testing for hallucinations
 		if answer_position < 0:
@@ -81,12 +139,22 @@ class LocalContextDataset(object):
 			'question': question, 
 			'answer': answer, 
 			'page': page_num, 
-			'document': document.strip()
+			'document': document
 		}
 
 		return out
 
 
+	def get_all(self, question_id=0, answer_positions=[0], total_contexts=[100000], get_tokens_batch=None):
+		# yields every (answer_position, total_context) variant of the question's document in one pass,
+		# skipping answer positions beyond the context length as our sweeps do
+		for answer_position in answer_positions:
+			for total_context in total_contexts:
+				if answer_position > total_context:
+					continue
+				yield answer_position, total_context, self.get(question_id=question_id, answer_position=answer_position, total_context=total_context, get_tokens_batch=get_tokens_batch)
+
+
 
 class NQ(LocalContextDataset):
 
@@ -94,21 +162,43 @@ class NQ(LocalContextDataset):
 		super(NQ, self).__init__()
 		self.path = path
 
+		# the source is only parsed the first time, or after it changes
+		store_path = os.path.join(os.path.dirname(self.path), 'store')
+		arena_path = os.path.join(os.path.dirname(self.path), 'arena')
+		source = source_id(self.path)
+		if not (is_built(store_path, source) and is_built(arena_path, source)):
+			self.build(store_path, arena_path, source)
+		self.source = source
+
+		self.dataset = RecordStore(store_path)
+		self.arena = FillerArena(arena_path)
+
+
+	def build(self, store_path, arena_path, source):
 		#load NQ dataset
 		with xopen(self.path, 'r') as f:
-			self.dataset = [json.loads(l) for i, l in enumerate(f) if (i < 255 and i not in [13, 32, 40, 164, 216])]
+			dataset = [json.loads(l) for i, l in enumerate(f) if (i < 255 and i not in [13, 32, 40, 164, 216])]
+
+		records = [{'question': example['question'], 'answers': example['answers'], 'nq_annotated_gold': {'chunked_long_answer': example['nq_annotated_gold']['chunked_long_answer']}} for example in dataset]
+		RecordStore.build(store_path, records, source=source)
+
+		# the filler of each question is its own retrieved documents without the answer
+		filler = [(doc['text'], i) for i, example in enumerate(dataset) for doc in example['ctxs'] if not doc['hasanswer']]
+		FillerArena.build(arena_path, [text for text, _ in filler], [i for _, i in filler], source=source)
+
+		return
 
 
 	@functools.lru_cache(maxsize=1)
 	@paginate
-	def get_materials(self, question_id=0, get_tokens=None):
+	def get_materials(self, question_id=0, get_tokens_batch=None):
 		example = self.dataset[question_id]
 
 		question = example['question']
 		answer = example['answers']
 		context = example['nq_annotated_gold']['chunked_long_answer'].strip()
 
-		filler = [doc['text'] for doc in example['ctxs'] if not doc['hasanswer']]
+		filler = self.arena.select(question_id)
 
 		return question, answer, context, filler
 
@@ -120,21 +210,43 @@ class Squad(LocalContextDataset):
 		super(Squad, self).__init__()
 		self.path = path
 
+		# the source is only parsed the first time, or after it changes
+		store_path = os.path.join(os.path.dirname(self.path), 'store')
+		arena_path = os.path.join(os.path.dirname(self.path), 'arena')
+		source = source_id(self.path)
+		if not (is_built(store_path, source) and is_built(arena_path, source)):
+			self.build(store_path, arena_path, source)
+		self.source = source
+
+		self.dataset = RecordStore(store_path)
+		self.arena = FillerArena(arena_path)
+
+
+	def build(self, store_path, arena_path, source):
 		#load squad dataset
 		with open(self.path, 'r') as f:
-			self.dataset = json.load(f)
+			dataset = json.load(f)
+
+		# only the first paragraph of each topic is asked about
+		RecordStore.build(store_path, [topic['paragraphs'][0] for topic in dataset['data']], source=source)
+
+		# the filler of each question is every paragraph but those of its topic
+		filler = [(par['context'], i) for i, topic in enumerate(dataset['data']) for par in topic['paragraphs']]
+		FillerArena.build(arena_path, [text for text, _ in filler], [i for _, i in filler], source=source)
+
+		return
 
 
 	@functools.lru_cache(maxsize=1)
 	@paginate
-	def get_materials(self, question_id=0, get_tokens=None):
-		example = self.dataset['data'][question_id]['paragraphs'][0]
+	def get_materials(self, question_id=0, get_tokens_batch=None):
+		example = self.dataset[question_id]
 
 		question = example['qas'][0]['question']
 		answer = example['qas'][0]['answers'][0]['text'].lower()
 		context = example['context'].strip()
 
-		filler = [par['context'] for i, topic in enumerate(self.dataset['data']) for par in topic['paragraphs'] if i != question_id]
+		filler = self.arena.exclude(question_id)
 
 		return question, answer, context, filler
 
@@ -145,14 +257,88 @@ class HotPotQA(object):
 	def __init__(self, path='data/hotpotqa/hotpot_train_v1.1.json'):
 		self.path = path
 
+		# the source is only parsed the first time, or after it changes
+		store_path = os.path.join(os.path.dirname(self.path), 'store')
+		arena_path = os.path.join(os.path.dirname(self.path), 'arena')
+		source = source_id(self.path)
+		# arenas built before the pool held every topic are rebuilt
+		if not (is_built(store_path, source) and is_built(arena_path, f'{source}:all')):
+			self.build(store_path, arena_path, source)
+		self.source = source
+
+		self.dataset = RecordStore(store_path)
+		self.arena = FillerArena(arena_path)
+		self.topic_sizes = np.bincount(self.arena.groups)
+
+		# per tokenizer, see page_number_tokens
+		self._page_number_tokens = {}
+		self._page_number_tokens_lock = threading.Lock()
+
+
+	def build(self, store_path, arena_path, source):
 		#load hotpotqa dataset
 		with open(self.path, 'r') as f:
 			hotpot = json.load(f)
-		self.dataset = [topic for topic in hotpot if topic['level']=='hard']
+
+		records = [{'question': topic['question'], 'answer': topic['answer'], 'context': topic['context']} for topic in hotpot if topic['level']=='hard']
+		RecordStore.build(store_path, records, source=source)
+
+		# the noise pool: the paragraphs of every topic, tokenized as far as they are used
+		texts = []
+		groups = []
+		for i, topic in enumerate(records):
+			noise_ = [' '.join(c[1]) for c in topic['context']]
+			texts.extend(noise_)
+			groups.extend([i]*len(noise_))
+		FillerArena.build(arena_path, texts, groups, source=f'{source}:all')
+
+		return
+
+
+	def noise(self, question_id, limit=5000):
+		# the noise of a question is whole topics other than its own, up to the first one that brings it
+		# to `limit` paragraphs, used last paragraph first
+		counts = np.cumsum(self.topic_sizes)
+		if question_id < len(self.topic_sizes):
+			counts[question_id:] -= self.topic_sizes[question_id]
+		last = int(np.searchsorted(counts, limit))
+
+		groups = np.asarray(self.arena.groups)
+		ids = np.flatnonzero((groups != question_id) & (groups <= last))
+		return ArenaView(self.arena, ids[::-1])
+
+
+	def page_number_tokens(self, get_tokens_batch, n):
+		# how many tokens a noise page gains when {PAGE} is replaced by each page number below `n`, which does
+		# not depend on the page's text for tokenizers that split at the newlines around it; returns None if that
+		# does not hold for a sample of pages, in which case the pages are tokenized with their numbers instead
+		with self._page_number_tokens_lock:
+			key = getattr(getattr(get_tokens_batch, '__self__', None), 'model_name', None) or id(get_tokens_batch)
+			reference = 'Text'
+			if key not in self._page_number_tokens:
+				tokens = self.arena.tokens(get_tokens_batch, min(len(self.arena), 4096))
+				sample = [(i, p) for i in range(0, len(tokens), max(1, len(tokens)//16)) for p in [1, 9, 10, 99, 100, 999, 1000, 12345]]
+				exact = get_tokens_batch([f'\n<PAGE {p}>\n{self.arena.text(i)}\n</PAGE {p}>\n' for i, p in sample])
+				delta = self.page_number_delta(get_tokens_batch, reference, [p for _, p in sample])
+				valid = all(tokens[i] + d == t for (i, _), d, t in zip(sample, delta, exact))
+				self._page_number_tokens[key] = np.zeros(0, dtype=np.int64) if valid \
+					else None
+
+			delta = self._page_number_tokens[key]
+			if delta is not None and len(delta) < n:
+				delta = np.concatenate([delta, self.page_number_delta(get_tokens_batch, reference, range(len(delta), max(n, 2*len(delta))))])
+				self._page_number_tokens[key] = delta
+
+			return delta
+
+
+	def page_number_delta(self, get_tokens_batch, reference, numbers):
+		base = get_tokens_batch([PAGE_TEMPLATE.format(text=reference)])[0]
+		return np.array(get_tokens_batch([f'\n<PAGE {p}>\n{reference}\n</PAGE {p}>\n' for p in numbers]), dtype=np.int64) - base
 
 
 	@functools.lru_cache(maxsize=1)
-	def get(self, question_id=0, answer_position=0, total_context=100000, get_tokens=None):
+	def get(self, question_id=0, answer_position=0, total_context=100000, get_tokens_batch=None):
 		# note: answer_position is only used to specify if we're testing for hallucinations
 
 		# ground truth answer and paragraphs
@@ -160,21 +346,53 @@ class HotPotQA(object):
 		question = target['question']
 		answer = target['answer']
 		contexts = [' '.join(c[1]) for c in target['context']]
-	
-		# everything else is junk filler
-		noise = []
-		for i,topic in enumerate(self.dataset):
-			if i != question_id:
-				noise_ = [' '.join(c[1]) for c in topic['context']]
-				noise.extend(noise_)
-			if len(noise) >= 5000:
+
+		# everything else is junk filler from the noise pool, of 5000 paragraphs as in our experiments
+		# unless the document needs more
+		limit = 5000
+		while True:
+			noise = self.noise(question_id, limit=limit)
+			out = self.assemble(contexts, noise, answer_position, total_context, get_tokens_batch)
+			if out is not None:
 				break
+			if limit >= len(self.arena):
+				raise ValueError(f'Ran out of noise paragraphs for question {question_id:d}.')
+			limit *= 2
+		document, page_nums = out
+
+		# if testing for hallucinations
+		if answer_position < 0:
+			answer = 'n/a'
+
+		out = {
+			'question': question, 
+			'answer': answer, 
+			'pages': page_nums, 
+			'document': document
+		}
+
+		return out
+
+
+	def assemble(self, contexts, noise, answer_position, total_context, get_tokens_batch):
+		# returns the document and its gold page numbers, or None if the noise runs out
+		noise_tokens = noise.tokens(get_tokens_batch)
+		delta = self.page_number_tokens(get_tokens_batch, len(noise) + len(contexts) + 1)
+
+		def page_tokens(k, page):
+			# token counts of the remaining noise pages from `noise[k]`, numbered from `page`
+			if delta is not None:
+				n = len(noise) - k
+				return noise_tokens[k:] + delta[page:page+n]
+			texts = [f'\n<PAGE {page+i}>\n{noise[k+i]}\n</PAGE {page+i}>\n' for i in range(min(64, len(noise)-k))]
+			return np.array(get_tokens_batch(texts), dtype=np.int64)
 
 		# start creating the context/document
-		document = ''
+		parts = []
 		page_nums = []
 		page_counter = 1
 		total_len = 0
+		k = 0
 	
 		# since there are multiple relevant paragraphs, split them evenly across context
 		l = len(contexts)
@@ -184,31 +402,54 @@ class HotPotQA(object):
 			# use artificial page numbers
 			if answer_position >= 0:  # negative means testing hallucinations
 				text = f'\n<PAGE {page_counter}>\n{context}\n</PAGE {page_counter}>\n'
-				document += text
+				parts.append(text)
 				page_nums.append(page_counter)
 				page_counter += 1
-				total_len += get_tokens(text)
+				total_len += get_tokens_batch([text])[0]
 
-			# add filler garbage until we reach the next relevant paragraph
+			# add filler garbage until we reach the next relevant paragraph,
+			# i.e. up to the first page at which the running total gets there
 			while total_len < (j+1)*interval:
-				garbage = noise.pop()
-				text = f'\n<PAGE {page_counter}>\n{garbage}\n</PAGE {page_counter}>\n'
-				document += text
-				page_counter += 1
-				total_len += get_tokens(text)
+				if k == len(noise):
+					return None
+				cumsum = total_len + np.cumsum(page_tokens(k, page_counter))
+				n = min(int(np.searchsorted(cumsum, (j+1)*interval)) + 1, len(cumsum))
+				parts.extend(f'\n<PAGE {page_counter+i}>\n{noise[k+i]}\n</PAGE {page_counter+i}>\n' for i in range(n))
+				k += n
+				page_counter += n
+				total_len = int(cumsum[n-1])
 
-		# if testing for hallucinations
-		if answer_position < 0:
-			answer = 'n/a'
+		return ''.join(parts).strip(), page_nums
 
-		out = {
-			'question': question, 
-			'answer': answer, 
-			'pages': page_nums, 
-			'document': document.strip()
-		}
 
-		return out
+
+def validate_question(qa):
+	# returns what is wrong with a generated question, or None
+	if type(qa) != dict:
+		return f'expected a JSON object, got {qa!r}'
+	if type(qa.get('question')) != str or len(qa['question'].strip()) == 0:
+		return f'no question in {qa!r}'
+	if type(qa.get('answer')) != list or not 1 <= len(qa['answer']) <= 5 or not all(type(a) == str for a in qa['answer']):
+		return f'the answer is not a list of 1 to 5 strings in {qa!r}'
+	return None
+
+
+# per-process tokenizer of the PubMed.collect_abstracts workers
+abstract_tokens_batch = None
+
+def init_abstract_worker(model_cls):
+	global abstract_tokens_batch
+	abstract_tokens_batch = load_model(model_cls).get_tokens_batch
+	return
+
+
+def filter_abstracts(lines, min_tokens, max_tokens):
+	D = [l.split('\t', 1)[1].strip() for l in lines if '\t' in l]
+	for i, abstract in enumerate(D):
+		if abstract.startswith('"') and abstract.endswith('"'):
+			D[i] = abstract[1:-1].strip()
+
+	return [abstract for abstract, tokens in zip(D, abstract_tokens_batch(D)) if min_tokens <= tokens <= max_tokens]
 
 
 
@@ -223,28 +464,77 @@ class PubMed(LocalContextDataset):
 		os.makedirs(self.output_dir, exist_ok=True)
 
 
-	def collect_abstracts(self, min_tokens=150, max_tokens=200):
-		get_tokens = load_model('openai').get_tokens
-
-		with open(self.input_file, 'r') as f:
-			D = f.readlines()
-
-		D = [l.split('\t', 1)[1].strip() for l in D if '\t' in l]
-		for i, abstract in enumerate(D):
-			if abstract.startswith('"') and abstract.endswith('"'):
-				D[i] = abstract[1:-1].strip()
-
-		D = [abstract for abstract in D if min_tokens <= get_tokens(abstract) <= max_tokens]
+	def collect_abstracts(self, min_tokens=150, max_tokens=200, model_cls='openai', num_workers=None, chunk_size=10000):
+		# streams the input a chunk of lines at a time to a pool of workers with their own tokenizers, and appends
+		# the abstracts they keep, in input order, to a partial file with a checkpoint so that an interrupted run resumes
+		partial_path = os.path.join(self.output_dir, 'abstracts.partial.jsonl')
+		progress_path = os.path.join(self.output_dir, 'abstracts.progress.json')
+
+		progress = {'input_file': os.path.abspath(self.input_file), 'offset': 0, 'lines': 0, 'kept': 0, 'output_size': 0}
+		if os.path.exists(progress_path):
+			with open(progress_path, 'r') as f:
+				saved = json.load(f)
+			if saved['input_file'] == progress['input_file']:
+				progress = saved
+				print(f'resuming after {progress["lines"]:d} lines')
+
+		num_workers = num_workers or os.cpu_count()
+		start_time = time.time()
+		start_lines = progress['lines']
+		with open(self.input_file, 'r') as f_in, open(partial_path, 'a') as f_out, \
+			ProcessPoolExecutor(max_workers=num_workers, initializer=init_abstract_worker, initargs=(model_cls,)) as executor:
+			f_in.seek(progress['offset'])
+			f_out.truncate(progress['output_size'])
+			f_out.seek(progress['output_size'])
+
+			# keep a couple of chunks per worker in flight, and collect them in the order they were read
+			pending = collections.deque()
+			while True:
+				while len(pending) < 2*num_workers:
+					lines = []
+					for _ in range(chunk_size):
+						l = f_in.readline()
+						if l == '':
+							break
+						lines.append(l)
+					if len(lines) == 0:
+						break
+					pending.append((executor.submit(filter_abstracts, lines, min_tokens, max_tokens), len(lines), f_in.tell()))
+				if len(pending) == 0:
+					break
+
+				future, n, offset = pending.popleft()
+				for abstract in future.result():
+					f_out.write(json.dumps(abstract) + '\n')
+				f_out.flush()
+
+				progress.update(offset=offset, lines=progress['lines']+n, kept=progress['kept']+len(future.result()), output_size=f_out.tell())
+				with open(progress_path + '.tmp', 'w') as f:
+					json.dump(progress, f)
+				os.replace(progress_path + '.tmp', progress_path)
+
+				rate = (progress['lines'] - start_lines)/max(time.time() - start_time, 1e-9)
+				print(f'{progress["lines"]:d} lines, {progress["kept"]:d} abstracts kept ({rate:.0f} lines/s)')
+
+		with open(partial_path, 'r') as f:
+			D = [json.loads(l) for l in f]
 		D.reverse()
 
 		with open(os.path.join(self.output_dir, 'abstracts.json'), 'w') as f:
 			json.dump(D, f, indent=2)
 
+		os.remove(partial_path)
+		# nothing is checkpointed if the input was empty
+		if os.path.exists(progress_path):
+			os.remove(progress_path)
+
 		return
 
 
-	def generate_questions(self, num_questions=10):
-		model = load_odel('openai')
+	def generate_questions(self, num_questions=10, model_cls='openai', max_workers=16, max_attempts=3):
+		# asks for the questions concurrently and appends each valid one to a journal as it arrives,
+		# so that a rerun only asks about the abstracts that are not in it yet
+		model = load_model(model_cls)
 
 		with open(os.path.join(self.output_dir, 'abstracts.json'), 'r') as f:
 			abstracts = json.load(f)
@@ -271,42 +561,122 @@ Return your response in JSON format with the following keys:
 `answer` (list[str]): up to 5 variations of the answer to the question
 </INSTRUCTIONS>'''
 
-		out = []
-		for i, abstract in enumerate(abstracts):
-			print(f'question {i:d} . . . ')
-			prompt = prompt_template.format(document=abstract)
-			qa = model.get_response(prompt, return_json=True)
-			qa['context'] = abstract
-			out.append(qa)
-
+		journal_path = os.path.join(self.output_dir, 'questions.journal.jsonl')
+		done = {}
+		if os.path.exists(journal_path):
+			with open(journal_path, 'r') as f:
+				for l in f:
+					# a line cut short by a crash is asked again
+					try:
+						item = json.loads(l)
+					except json.JSONDecodeError:
+						continue
+					# entries from a run with more questions than this one are left out
+					if item['index'] < len(abstracts) and item['context'] == abstracts[item['index']]:
+						done[item['index']] = item
+
+		def ask(i):
+			# re-ask, a little less deterministically, only while the response is not a valid question
+			prompt = prompt_template.format(document=abstracts[i])
+			for attempt in range(max_attempts):
+				try:
+					qa = model.get_response(prompt, temperature=0 if attempt == 0 else 0.5, return_json=True)
+				except Exception as e:
+					error = e
+					continue
+				error = validate_question(qa)
+				if error is None:
+					return {'index': i, 'question': qa['question'], 'answer': qa['answer'], 'context': abstracts[i]}
+			print(f'question {i:d} failed: {error}')
+			return None
+
+		todo = [i for i in range(len(abstracts)) if i not in done]
+		print(f'{len(done):d} questions already done, {len(todo):d} to go')
+		with open(journal_path, 'a') as f, ThreadPoolExecutor(max_workers=max_workers) as executor:
+			for future in as_completed([executor.submit(ask, i) for i in todo]):
+				item = future.result()
+				if item is None:
+					continue
+				f.write(json.dumps(item) + '\n')
+				f.flush()
+				done[item['index']] = item
+				print(f'question {item["index"]:d} done ({len(done):d}/{len(abstracts):d})')
+
+		# question IDs index the abstracts, so none may be missing
+		missing = [i for i in range(len(abstracts)) if i not in done]
+		if len(missing) > 0:
+			raise RuntimeError(f'No valid question for abstracts {missing}; run again to retry them.')
+
+		out = [{'question': done[i]['question'], 'answer': done[i]['answer'], 'context': done[i]['context']} for i in range(len(abstracts))]
 		with open(os.path.join(self.output_dir, 'questions.json'), 'w') as f:
 			json.dump(out, f, indent=2)
 
 		return
 
 
+	@property
+	def source(self):
+		# the documents come from the questions and the abstracts, once both are built
+		return f"{source_id(os.path.join(self.output_dir, 'questions.json'))}|{source_id(os.path.join(self.output_dir, 'abstracts.json'))}"
+
+
 	@functools.lru_cache(maxsize=1)
 	@paginate
-	def get_materials(self, question_id=0, get_tokens=None):
+	def get_materials(self, question_id=0, get_tokens_batch=None):
 		if self.dataset is None:
-			self.dataset = {}
-			for thing in ['abstracts', 'questions']:
-				with open(os.path.join(self.output_dir, f'{thing}.json'), 'r') as f:
-					self.dataset[thing] = json.load(f)
+			with open(os.path.join(self.output_dir, 'questions.json'), 'r') as f:
+				self.dataset = {'questions': json.load(f)}
+
+			# the filler of each question is every abstract but its own
+			abstracts_path = os.path.join(self.output_dir, 'abstracts.json')
+			arena_path = os.path.join(self.output_dir, 'arena')
+			source = source_id(abstracts_path)
+			if not is_built(arena_path, source):
+				with open(abstracts_path, 'r') as f:
+					abstracts = json.load(f)
+				FillerArena.build(arena_path, abstracts, list(range(len(abstracts))), source=source)
+			self.dataset['abstracts'] = FillerArena(arena_path)
 
 		qa = self.dataset['questions'][question_id]
 		question = qa['question']
 		answer = qa['answer']
 		context = qa['context']
 
-		filler = self.dataset['abstracts'][:]
-		filler.pop(question_id)
+		filler = self.dataset['abstracts'].exclude(question_id)
+
+		return question, answer, context, filler
+
+
+
+class Synthetic(LocalContextDataset):
+
+	# random word salad with one planted fact per question, for exercising the pipeline without any data files
+	def __init__(self, num_questions=50, num_paragraphs=5000, paragraph_words=100, seed=0):
+		super(Synthetic, self).__init__()
+		self.source = f'synthetic:{num_questions:d}:{num_paragraphs:d}:{paragraph_words:d}:{seed}'
+		rng = random.Random(seed)
+
+		vocabulary = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 10))) for _ in range(5000)]
+		self.dataset = {
+			'answers': [rng.choice(vocabulary) for _ in range(num_questions)], 
+			'paragraphs': [' '.join(rng.choices(vocabulary, k=paragraph_words)).capitalize() + '.' for _ in range(num_paragraphs)]
+		}
+
+
+	@functools.lru_cache(maxsize=1)
+	@paginate
+	def get_materials(self, question_id=0, get_tokens_batch=None):
+		question = f'What is the secret code number {question_id:d}?'
+		answer = self.dataset['answers'][question_id]
+		context = f'The secret code number {question_id:d} is {answer}. ' + self.dataset['paragraphs'][question_id]
+
+		filler = self.dataset['paragraphs'][:question_id] + self.dataset['paragraphs'][question_id+1:]
 
 		return question, answer, context, filler
 
 
 
 def load_dataset(dataset_name, **kwargs):
-	dataset_dict = {'nq': NQ, 'squad': Squad, 'hotpotqa': HotPotQA, 'pubmed': PubMed}
+	dataset_dict = {'nq': NQ, 'squad': Squad, 'hotpotqa': HotPotQA, 'pubmed': PubMed, 'synthetic': Synthetic}
 	dataset = dataset_dict[dataset_name.lower()](**kwargs)
 	return dataset
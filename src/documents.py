@@ -0,0 +1,137 @@
+import os
+import json
+import argparse
+import functools
+import pathlib
+from xopen import xopen
+from .datasets import load_dataset
+from .models import load_model
+from .parsers import split_pages
+
+### materialized documents
+# every (question_id, answer_position, total_context) document of a sweep rendered once per dataset and
+# tokenizer, one gzipped JSONL shard per question, with a manifest of where each document is along with
+# its page token counts and gold page numbers; `run(..., document_store=...)` then reads them from there.
+# the manifest records which data (`dataset.source`) the documents were rendered from, and runs refuse a
+# store that does not match the dataset they are given
+
+class DocumentStore(object):
+
+	def __init__(self, path):
+		self.path = path
+		with open(os.path.join(self.path, 'manifest.json'), 'r') as f:
+			manifest = json.load(f)
+
+		self.dataset_name = manifest['dataset_name']
+		self.dataset_source = manifest.get('dataset_source')
+		self.model_name = manifest['model_name']
+		self.entries = {(e['question_id'], e['answer_position'], e['total_context']): e for e in manifest['entries']}
+
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+
+	@functools.lru_cache(maxsize=4)
+	def load_shard(self, shard):
+		with xopen(os.path.join(self.path, shard), 'r') as f:
+			return [json.loads(l) for l in f]
+
+
+	def get(self, question_id=0, answer_position=0, total_context=100000):
+		entry = self.entries[(question_id, answer_position, total_context)]
+		# runs add their results to the example, so hand out a copy
+		return dict(self.load_shard(entry['shard'])[entry['line']])
+
+
+	def page_tokens(self, question_id=0, answer_position=0, total_context=100000):
+		# token counts of the pages of a document, as split by `split_pages`
+		return self.entries[(question_id, answer_position, total_context)]['page_tokens']
+
+
+
+def load_document_store(dataset_name, model_name, path='documents'):
+	# returns None if the documents have not been materialized
+	store_path = os.path.join(path, dataset_name, model_name)
+	if not os.path.exists(os.path.join(store_path, 'manifest.json')):
+		return None
+	return DocumentStore(store_path)
+
+
+
+def materialize(dataset_name, model, path='documents', question_ids=None, answer_positions=None, total_contexts=[10000, 20000, 40000, 80000], **dataset_kwargs):
+	# renders the grid of our sweep scripts by default, skipping documents already in the manifest;
+	# `dataset_kwargs` go to load_dataset
+	dataset = load_dataset(dataset_name, **dataset_kwargs)
+	if question_ids is None:
+		question_ids = range(250) if dataset_name == 'hotpotqa' else range(50)
+	if answer_positions is None:
+		answer_positions = [0] if dataset_name == 'hotpotqa' else range(0, max(total_contexts)+1, 10000)
+
+	store_path = os.path.join(path, dataset_name, model.model_name)
+	pathlib.Path(store_path).mkdir(parents=True, exist_ok=True)
+	manifest_path = os.path.join(store_path, 'manifest.json')
+	if os.path.exists(manifest_path):
+		with open(manifest_path, 'r') as f:
+			manifest = json.load(f)
+	else:
+		manifest = {'dataset_name': dataset_name, 'dataset_source': dataset.source, 'model_name': model.model_name, 'entries': []}
+	if manifest.get('dataset_source') != dataset.source:
+		raise ValueError(f'The documents in {store_path} were rendered from other data than {dataset_name} now has; remove them to start over.')
+	done = set((e['question_id'], e['answer_position'], e['total_context']) for e in manifest['entries'])
+	shards = set(e['shard'] for e in manifest['entries'])
+
+	for question_id in question_ids:
+		keys = [(question_id, answer_position, total_context) for answer_position in answer_positions for total_context in total_contexts \
+			if answer_position <= total_context and (question_id, answer_position, total_context) not in done]
+		if len(keys) == 0:
+			continue
+		print(f'{dataset_name} q{question_id:d}: {len(keys):d} documents')
+
+		# documents added to a question later on go to a shard of their own
+		shard = f'q{question_id:d}.jsonl.gz'
+		k = 1
+		while shard in shards:
+			shard = f'q{question_id:d}-{k:d}.jsonl.gz'
+			k += 1
+
+		entries = []
+		with xopen(os.path.join(store_path, shard), 'w') as f:
+			for _, answer_position, total_context in keys:
+				example = dataset.get(question_id=question_id, answer_position=answer_position, total_context=total_context, get_tokens_batch=model.get_tokens_batch)
+				f.write(json.dumps(example) + '\n')
+				entries.append({
+					'question_id': question_id,
+					'answer_position': answer_position,
+					'total_context': total_context,
+					'shard': shard,
+					'line': len(entries),
+					'gold_pages': example['pages'] if 'pages' in example else [example['page']],
+					'page_tokens': model.get_tokens_batch(split_pages(example['document']))
+				})
+
+		# the manifest is only updated once the shard is complete
+		manifest['entries'].extend(entries)
+		with open(manifest_path + '.tmp', 'w') as f:
+			json.dump(manifest, f)
+		os.replace(manifest_path + '.tmp', manifest_path)
+
+	return DocumentStore(store_path)
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Render the documents of a sweep once and store them for run(..., document_store=...).')
+	parser.add_argument('datasets', nargs='+', help='e.g. nq squad hotpotqa pubmed')
+	parser.add_argument('--model', choices=['openai', 'anthropic', 'mock'], default='openai', help='whose tokenizer to measure the documents with')
+	parser.add_argument('--path', default='documents')
+	parser.add_argument('--context-lens', type=int, nargs='+', default=[10000, 20000, 40000, 80000])
+	args = parser.parse_args()
+
+	model = load_model(args.model)
+	for dataset_name in args.datasets:
+		store = materialize(dataset_name, model, path=args.path, total_contexts=args.context_lens)
+		print(f'{len(store):d} documents in {store.path}')
@@ -0,0 +1,118 @@
+import json
+import time
+import uuid
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .models import MockAPIError, MockModel
+
+### a local OpenAI-compatible stand-in backed by MockModel
+# point OpenAIModel at it with OPENAI_BASE_URL=http://127.0.0.1:8000/v1 and any OPENAI_API_KEY
+
+def usage(input_tokens, output_tokens, cached_input_tokens):
+	return {'prompt_tokens': input_tokens, 'completion_tokens': output_tokens, 'total_tokens': input_tokens + output_tokens, 'prompt_tokens_details': {'cached_tokens': cached_input_tokens}}
+
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+
+	def do_POST(self):
+		if not self.path.endswith('/chat/completions'):
+			return self.send_json(404, {'error': {'message': f'Unknown path {self.path}.'}})
+
+		body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+		query_text = body['messages'][-1]['content']
+
+		details = {}
+		try:
+			out, input_tokens, output_tokens = self.server.model._get_response(query_text, max_tokens=body.get('max_tokens', 4000), temperature=body.get('temperature', 0), details=details)
+		except MockAPIError as e:
+			headers = {'Retry-After': e.response.headers['retry-after']} if 'retry-after' in e.response.headers else {}
+			return self.send_json(e.status_code, {'error': {'message': str(e)}}, headers=headers)
+
+		if body.get('stream', False):
+			return self.send_stream(body, out, input_tokens, output_tokens, details['cached_input_tokens'])
+
+		response = {
+			'id': f'chatcmpl-{uuid.uuid4().hex}',
+			'object': 'chat.completion',
+			'created': int(time.time()),
+			'model': body.get('model', 'mock'),
+			'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': out}, 'finish_reason': 'stop'}],
+			'usage': usage(input_tokens, output_tokens, details['cached_input_tokens'])
+		}
+
+		return self.send_json(200, response)
+
+
+	def send_stream(self, body, out, input_tokens, output_tokens, cached_input_tokens):
+		# server-sent events, a few characters per chunk, then a usage chunk if asked for
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/event-stream')
+		self.send_header('Connection', 'close')
+		self.end_headers()
+		self.close_connection = True
+
+		chunk_id = f'chatcmpl-{uuid.uuid4().hex}'
+		def chunk(choices, usage=None):
+			data = {'id': chunk_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': body.get('model', 'mock'), 'choices': choices, 'usage': usage}
+			return f'data: {json.dumps(data)}\n\n'.encode('utf-8')
+
+		try:
+			for i in range(0, len(out), 8):
+				self.wfile.write(chunk([{'index': 0, 'delta': {'content': out[i:i+8]}, 'finish_reason': None}]))
+			self.wfile.write(chunk([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+			if body.get('stream_options', {}).get('include_usage', False):
+				self.wfile.write(chunk([], usage=usage(input_tokens, output_tokens, cached_input_tokens)))
+			self.wfile.write(b'data: [DONE]\n\n')
+		except (BrokenPipeError, ConnectionResetError):
+			# the client stopped reading early
+			pass
+
+		return
+
+
+	def send_json(self, status_code, body, headers={}):
+		data = json.dumps(body).encode('utf-8')
+		self.send_response(status_code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		for k, v in headers.items():
+			self.send_header(k, v)
+		self.end_headers()
+		self.wfile.write(data)
+		return
+
+
+	def log_message(self, *args):
+		return
+
+
+
+def serve(host='127.0.0.1', port=8000, background=False, **kwargs):
+	server = ThreadingHTTPServer((host, port), MockHandler)
+	server.daemon_threads = True
+	server.model = MockModel(**kwargs)
+
+	if background:
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+	else:
+		server.serve_forever()
+
+	return server
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Serve a mock OpenAI-compatible chat completions endpoint.')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8000)
+	parser.add_argument('--latency', type=float, default=1.0, help='median latency in seconds')
+	parser.add_argument('--latency-sigma', type=float, default=0.5, help='sigma of the lognormal latency')
+	parser.add_argument('--error-rate', type=float, default=0)
+	parser.add_argument('--rate-limit-rate', type=float, default=0)
+	args = parser.parse_args()
+
+	serve(host=args.host, port=args.port, latency=args.latency, latency_sigma=args.latency_sigma, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate)
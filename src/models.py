@@ -1,100 +1,530 @@
 import os
+import re
+import json
 import time
+import random
+import atexit
+import asyncio
+import weakref
+import email.utils
+import hashlib
+import threading
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 import tiktoken
+import numpy as np
 import openai
 from openai import OpenAI
-from anthropic import Anthropic, HUMAN_PROMPT, AI_PROMPT, BadRequestError
+import anthropic
+from anthropic import Anthropic, HUMAN_PROMPT, AI_PROMPT
 from dotenv import load_dotenv
-from tenacity import retry, retry_if_not_exception_type, stop_after_attempt, wait_random_exponential
 
-from .parsers import parse_json
+from .cache import ResponseCache
+from .parsers import JSONExtractor, parse_json
+from .prompts import Prompt
+
+
+class RateLimiter(object):
+
+	# token buckets for requests and tokens per minute; either limit may be None
+	def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+		self.requests_per_minute = requests_per_minute
+		self.tokens_per_minute = tokens_per_minute
+
+		self._requests = requests_per_minute or 0
+		self._tokens = tokens_per_minute or 0
+		self._updated = time.monotonic()
+		self._blocked_until = 0
+		self._lock = threading.Lock()
+
+
+	def _refill(self, now):
+		elapsed = now - self._updated
+		if self.requests_per_minute:
+			self._requests = min(self.requests_per_minute, self._requests + elapsed*self.requests_per_minute/60)
+		if self.tokens_per_minute:
+			self._tokens = min(self.tokens_per_minute, self._tokens + elapsed*self.tokens_per_minute/60)
+		self._updated = now
+		return
+
+
+	def acquire(self, tokens=0):
+		# block until both buckets cover the request, then charge it
+		if self.tokens_per_minute:
+			tokens = min(tokens, self.tokens_per_minute)
+
+		while True:
+			with self._lock:
+				now = time.monotonic()
+				self._refill(now)
+
+				wait = self._blocked_until - now
+				if self.requests_per_minute and self._requests < 1:
+					wait = max(wait, (1 - self._requests)*60/self.requests_per_minute)
+				if self.tokens_per_minute and self._tokens < tokens:
+					wait = max(wait, (tokens - self._tokens)*60/self.tokens_per_minute)
+
+				if wait <= 0:
+					self._requests -= 1
+					self._tokens -= tokens
+					return
+
+			time.sleep(wait)
+
+
+	def charge(self, tokens):
+		# tokens only known after the response (e.g. output tokens) put the bucket into debt
+		with self._lock:
+			self._refill(time.monotonic())
+			self._tokens -= tokens
+		return
+
+
+	def block(self, seconds):
+		# the provider told us to back off, so nobody sends until then
+		with self._lock:
+			self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+		return
+
+
+
+def retry_after(e):
+	# seconds to wait according to the Retry-After headers of an API error, if any
+	response = getattr(e, 'response', None)
+	if response is None:
+		return None
+
+	headers = response.headers
+	if 'retry-after-ms' in headers:
+		try:
+			return float(headers['retry-after-ms'])/1000
+		except ValueError:
+			pass
+
+	if 'retry-after' in headers:
+		try:
+			return float(headers['retry-after'])
+		except ValueError:
+			pass
+		# otherwise it should be an HTTP date
+		try:
+			date = email.utils.parsedate_to_datetime(headers['retry-after'])
+			return max(0, date.timestamp() - time.time())
+		except (TypeError, ValueError):
+			pass
+
+	return None
+
+
+def is_retryable(e):
+	status_code = getattr(e, 'status_code', None)
+	if status_code is None:
+		return isinstance(e, (openai.APIConnectionError, anthropic.APIConnectionError, httpx.TransportError))
+	return status_code in [408, 409, 429] or status_code >= 500
+
 
 
 class Model(object):
 
-	def __init__(self, path_to_env=None):
+	# pooled HTTP clients per process, one per pool size, each shared by every model instance and thread that asks for it
+	_http_clients = {}
+	_http_client_pid = None
+	_http_client_lock = threading.Lock()
+
+	def __init__(self, path_to_env=None, pool_size=100, token_cache_size=2**16, max_concurrency=16, cache=None, requests_per_minute=None, tokens_per_minute=None, max_retries=3, stream=False, telemetry=None):
 		self.path_to_env = path_to_env
+		self.pool_size = pool_size
+
+		# stream responses, stopping early once an expected JSON value closes
+		self.stream = stream
+
+		# optional Telemetry that every API request (not cache hits) is reported to
+		self.telemetry = telemetry
+
+		# optional ResponseCache consulted before every request
+		self.cache = cache
+
+		# bounds the number of requests in flight from get_response_async
+		self.max_concurrency = max_concurrency
+		self._executor = None
+		self._semaphores = weakref.WeakKeyDictionary()
+		self._async_lock = threading.Lock()
+
+		# LRU of token counts keyed by content hash
+		self.token_cache_size = token_cache_size
+		self._token_cache = collections.OrderedDict()
+		self._token_cache_lock = threading.Lock()
+
+		self._client = None
+		self._client_http = None
+		self._client_lock = threading.Lock()
 
 		self.input_tokens = 0
 		self.output_tokens = 0
+		self.cached_input_tokens = 0
+		self._tokens_lock = threading.Lock()
 
-		if not os.path.exists(self.path_to_env):
-			raise ValueError(f'The file {self.path_to_env} does not exist.')
-
-		load_dotenv(self.path_to_env)
+		# offline backends such as MockModel need no env file
+		if self.path_to_env is not None:
+			if not os.path.exists(self.path_to_env):
+				raise ValueError(f'The file {self.path_to_env} does not exist.')
+			load_dotenv(self.path_to_env)
 
 		self.model_name = os.getenv('MODEL_NAME')
 
+		# rate limits may also be set in the env file
+		requests_per_minute = requests_per_minute or int(os.getenv('REQUESTS_PER_MINUTE', 0))
+		tokens_per_minute = tokens_per_minute or int(os.getenv('TOKENS_PER_MINUTE', 0))
+		self.rate_limiter = RateLimiter(requests_per_minute or None, tokens_per_minute or None) if (requests_per_minute or tokens_per_minute) \
+			else None
+		self.max_retries = max_retries
+
 
 	def _get_response(self, *args, **kwargs):
 		raise NotImplemented
 
-	def get_response(self, *args, **kwargs):
-		out, input_tokens, output_tokens = self._get_response(*args, **kwargs)
-
-		self.input_tokens += input_tokens
-		self.output_tokens += output_tokens
-
-		if 'return_json' in kwargs and kwargs['return_json']:
+	def get_response(self, query_text, max_tokens=4000, temperature=0, return_json=False, words_in_mouth=None, usage=None, stop_after_json=False, timings=None):
+		# `timings`, if given, is filled with time_to_first_token and time_to_json in seconds
+		# the backend fills `details` with the input tokens it served from its prompt cache, if it reports them
+		details = {}
+		kwargs = {'max_tokens': max_tokens, 'temperature': temperature, 'return_json': return_json, 'details': details}
+		if words_in_mouth is not None:
+			kwargs['words_in_mouth'] = words_in_mouth
+		if self.stream:
+			kwargs.update(stream=True, stop_after_json=stop_after_json, timings=timings)
+
+		# cached responses are replayed with the token counts of the original request,
+		# but without cached input tokens, since no prompt reached the provider
+		cached = None
+		if self.cache is not None:
+			key = self.cache_key(query_text, max_tokens=max_tokens, temperature=temperature, words_in_mouth=words_in_mouth)
+			cached = self.cache.get(key)
+
+		if cached is not None:
+			out, input_tokens, output_tokens = cached
+		else:
+			start_time = time.perf_counter()
+			out, input_tokens, output_tokens = self._request(query_text, **kwargs)
+			# without streaming, the first token and the JSON arrive with the whole response
+			if timings is not None and not self.stream:
+				timings['time_to_first_token'] = timings['time_to_json'] = time.perf_counter() - start_time
+			if self.cache is not None:
+				self.cache.put(key, out, input_tokens, output_tokens)
+
+		self.add_tokens(input_tokens, output_tokens, usage=usage, cached_input_tokens=details.get('cached_input_tokens', 0))
+
+		if return_json:
 			out = parse_json(out)
 
 		return out
 
 
+	def _request(self, query_text, **kwargs):
+		start_time = time.perf_counter()
+		for attempt in range(self.max_retries+1):
+			# charge the prompt against the rate limits before sending it, counted from its parts if it has them
+			if self.rate_limiter is not None:
+				self.rate_limiter.acquire(query_text.tokens if isinstance(query_text, Prompt) else self.get_tokens(query_text))
+
+			try:
+				out, input_tokens, output_tokens = self._get_response(query_text, **kwargs)
+			except Exception as e:
+				if attempt == self.max_retries or not is_retryable(e):
+					if self.telemetry is not None:
+						self.telemetry.record(time.perf_counter() - start_time, retries=attempt, error=e)
+					raise
+
+				delay = retry_after(e)
+				if delay is None:
+					delay = random.uniform(0, min(60, 2**attempt))
+				if self.rate_limiter is not None:
+					self.rate_limiter.block(delay)
+				else:
+					time.sleep(delay)
+				continue
+
+			if self.rate_limiter is not None:
+				self.rate_limiter.charge(output_tokens)
+			if self.telemetry is not None:
+				self.telemetry.record(time.perf_counter() - start_time, input_tokens=input_tokens, output_tokens=output_tokens, retries=attempt, cached_input_tokens=kwargs['details'].get('cached_input_tokens', 0))
+
+			return out, input_tokens, output_tokens
+
+
+	def cache_key(self, query_text, max_tokens=4000, temperature=0, words_in_mouth=None):
+		return ResponseCache.make_key(self.model_name, query_text, max_tokens, temperature, words_in_mouth)
+
+
+	### batch files (OpenAI chat completions format unless overridden)
+
+	def batch_request(self, custom_id, query_text, max_tokens=4000, temperature=0, words_in_mouth=None, **kwargs):
+		body = {
+			'model': self.model_name, 
+			'messages': [{'role': 'user', 'content': query_text}], 
+			'max_tokens': max_tokens, 
+			'temperature': temperature
+		}
+		return {'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions', 'body': body}
+
+	def parse_batch_result(self, result, request):
+		# returns custom_id, and response and token counts or Nones for a failed request
+		response = result.get('response')
+		if result.get('error') is not None or response is None or response['status_code'] != 200:
+			return result['custom_id'], None, None, None
+
+		body = response['body']
+		out = body['choices'][0]['message']['content']
+		return result['custom_id'], out, body['usage']['prompt_tokens'], body['usage']['completion_tokens']
+
+
+	def _get_semaphore(self):
+		# asyncio primitives belong to one event loop, so keep one semaphore per loop
+		loop = asyncio.get_running_loop()
+		with self._async_lock:
+			if loop not in self._semaphores:
+				self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+			return self._semaphores[loop]
+
+	@property
+	def executor(self):
+		with self._async_lock:
+			if self._executor is None:
+				self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix=type(self).__name__)
+			return self._executor
+
+	async def get_response_async(self, *args, **kwargs):
+		async with self._get_semaphore():
+			loop = asyncio.get_running_loop()
+			return await loop.run_in_executor(self.executor, functools.partial(self.get_response, *args, **kwargs))
+
+
+	def add_tokens(self, input_tokens, output_tokens, usage=None, cached_input_tokens=0):
+		# `usage` is an optional per-caller dict accumulated alongside the model totals;
+		# `cached_input_tokens` is the part of `input_tokens` read from the provider's prompt cache
+		with self._tokens_lock:
+			self.input_tokens += input_tokens
+			self.output_tokens += output_tokens
+			self.cached_input_tokens += cached_input_tokens
+			if usage is not None:
+				usage['input_tokens'] = usage.get('input_tokens', 0) + input_tokens
+				usage['output_tokens'] = usage.get('output_tokens', 0) + output_tokens
+				usage['cached_input_tokens'] = usage.get('cached_input_tokens', 0) + cached_input_tokens
+		return
+
 	def reset_tokens(self):
-		self.input_tokens = 0
-		self.output_tokens = 0
+		with self._tokens_lock:
+			self.input_tokens = 0
+			self.output_tokens = 0
+			self.cached_input_tokens = 0
 		return
 
 
+	def _count_tokens(self, texts):
+		raise NotImplemented
+
+	def get_tokens_batch(self, texts):
+		keys = [hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest() for text in texts]
+		counts = [None] * len(texts)
+
+		# look up cached counts, grouping duplicate texts that still need counting
+		missing = collections.OrderedDict()
+		with self._token_cache_lock:
+			for i, key in enumerate(keys):
+				if key in self._token_cache:
+					self._token_cache.move_to_end(key)
+					counts[i] = self._token_cache[key]
+				else:
+					missing.setdefault(key, []).append(i)
+
+		if len(missing) == 0:
+			return counts
+
+		new_counts = self._count_tokens([texts[idxs[0]] for idxs in missing.values()])
+
+		with self._token_cache_lock:
+			for (key, idxs), num_tokens in zip(missing.items(), new_counts):
+				for i in idxs:
+					counts[i] = num_tokens
+				self._token_cache[key] = num_tokens
+				self._token_cache.move_to_end(key)
+			while len(self._token_cache) > self.token_cache_size:
+				self._token_cache.popitem(last=False)
+
+		return counts
+
+	def get_tokens(self, text):
+		return self.get_tokens_batch([text])[0]
+
+	def _count_usage(self, query_text, out):
+		# input and output tokens of a request we have to count ourselves; a Prompt knows its own count
+		if isinstance(query_text, Prompt):
+			return query_text.tokens, self.get_tokens(out)
+		input_tokens, output_tokens = self.get_tokens_batch([query_text, out])
+		return input_tokens, output_tokens
+
+
+	@staticmethod
+	def get_http_client(pool_size=100):
+		with Model._http_client_lock:
+			# a forked worker must not reuse the parent's sockets
+			if Model._http_client_pid != os.getpid():
+				Model._http_clients = {}
+				Model._http_client_pid = os.getpid()
+			# keyed by pool size, so that a model never gets a smaller pool than it asked for
+			if pool_size not in Model._http_clients:
+				Model._http_clients[pool_size] = httpx.Client(
+					limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=60),
+					timeout=httpx.Timeout(600, connect=10)
+				)
+			return Model._http_clients[pool_size]
+
+
+	@staticmethod
+	def close_http_client():
+		with Model._http_client_lock:
+			if Model._http_client_pid == os.getpid():
+				for http_client in Model._http_clients.values():
+					http_client.close()
+			Model._http_clients = {}
+			Model._http_client_pid = None
+		return
+
+
+	def _make_client(self, http_client):
+		raise NotImplemented
+
+	@property
+	def client(self):
+		http_client = self.get_http_client(self.pool_size)
+		with self._client_lock:
+			if self._client is None or self._client_http is not http_client:
+				self._client = self._make_client(http_client)
+				self._client_http = http_client
+			return self._client
+
+
 
 class OpenAIModel(Model):
 
-	def __init__(self, path_to_env='configs/openai.env'):
-		super(OpenAIModel, self).__init__(path_to_env=path_to_env)
+	def __init__(self, path_to_env='configs/openai.env', token_threads=8, **kwargs):
+		super(OpenAIModel, self).__init__(path_to_env=path_to_env, **kwargs)
+		self.token_threads = token_threads
 
 		openai.api_key = os.getenv('OPENAI_KEY')
 		openai.organization = os.getenv('OPENAI_ORG_ID')
 
 
-	@retry(stop=stop_after_attempt(3), wait=wait_random_exponential(multiplier=1, max=60))
-	def _get_response(self, query_text, max_tokens=4000, temperature=0, return_json=False, words_in_mouth=None):
-		client_instance = OpenAI()
+	def _make_client(self, http_client):
+		# retries are handled by Model._request
+		return OpenAI(http_client=http_client, max_retries=0)
+
 
-		response = client_instance.chat.completions.create(
+	def _get_response(self, query_text, max_tokens=4000, temperature=0, return_json=False, words_in_mouth=None, stream=False, stop_after_json=False, timings=None, details=None):
+		if stream:
+			return self._get_streamed_response(query_text, max_tokens=max_tokens, temperature=temperature, stop_after_json=stop_after_json, timings=timings, details=details)
+
+		response = self.client.chat.completions.create(
 			model = self.model_name, 
 			messages = [{"role":"user","content":query_text}],
 			max_tokens = max_tokens,
 			temperature = temperature
 		)
 
-		client_instance.close()
-
 		out = response.choices[0].message.content
 
 		input_tokens = response.usage.prompt_tokens
 		output_tokens = response.usage.completion_tokens
+		self._record_cached_tokens(response.usage, details)
 
 		return out, input_tokens, output_tokens
 
 
-	def get_tokens(self, text):
-		encoding = tiktoken.encoding_for_model(self.model_name)
-		num_tokens = len(encoding.encode(text))
-		return num_tokens
+	def _get_streamed_response(self, query_text, max_tokens=4000, temperature=0, stop_after_json=False, timings=None, details=None):
+		timings = {} if timings is None else timings
+		start_time = time.perf_counter()
+
+		response = self.client.chat.completions.create(
+			model = self.model_name, 
+			messages = [{"role":"user","content":query_text}],
+			max_tokens = max_tokens,
+			temperature = temperature,
+			stream = True,
+			stream_options = {'include_usage': True}
+		)
+
+		out = ''
+		usage = None
+		extractor = JSONExtractor()
+		try:
+			for chunk in response:
+				if chunk.usage is not None:
+					usage = chunk.usage
+				if len(chunk.choices) == 0 or chunk.choices[0].delta.content is None:
+					continue
+
+				text = chunk.choices[0].delta.content
+				timings.setdefault('time_to_first_token', time.perf_counter() - start_time)
+				out += text
+
+				# stop paying for output once the answer is complete
+				if stop_after_json and extractor.feed(text):
+					timings['time_to_json'] = time.perf_counter() - start_time
+					break
+		finally:
+			response.close()
+
+		timings.setdefault('time_to_json', time.perf_counter() - start_time)
+
+		# usage only arrives with the last chunk, so count it ourselves if we stopped early
+		if usage is not None:
+			input_tokens = usage.prompt_tokens
+			output_tokens = usage.completion_tokens
+			self._record_cached_tokens(usage, details)
+		else:
+			input_tokens, output_tokens = self._count_usage(query_text, out)
+
+		return out, input_tokens, output_tokens
+
+
+	@staticmethod
+	def _record_cached_tokens(usage, details):
+		# prompts of 1024+ tokens are cached automatically, and the hits are reported here
+		prompt_tokens_details = getattr(usage, 'prompt_tokens_details', None)
+		if details is not None and prompt_tokens_details is not None:
+			details['cached_input_tokens'] = prompt_tokens_details.cached_tokens or 0
+		return
+
+
+	@functools.cached_property
+	def encoding(self):
+		return tiktoken.encoding_for_model(self.model_name)
+
+	def _count_tokens(self, texts):
+		return [len(tokens) for tokens in self.encoding.encode_ordinary_batch(texts, num_threads=self.token_threads)]
 
 
 
 class AnthropicModel(Model):
 
-	def __init__(self, path_to_env='configs/anthropic.env'):
-		super(AnthropicModel, self).__init__(path_to_env=path_to_env)
+	def __init__(self, path_to_env='configs/anthropic.env', **kwargs):
+		super(AnthropicModel, self).__init__(path_to_env=path_to_env, **kwargs)
+
+		# (offline estimate, count reported by the API) pairs for calibration_report
+		self.token_calibration = []
+		self._token_calibration_lock = threading.Lock()
+
+
+	def _make_client(self, http_client):
+		return Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'), http_client=http_client, max_retries=0)
+
 
-	@retry(retry=retry_if_not_exception_type(BadRequestError), stop=stop_after_attempt(3), wait=wait_random_exponential(multiplier=1, max=60))
-	def _get_response(self, query_text, max_tokens=4000, temperature=0, return_json=False, words_in_mouth=''):
-		client_instance = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
+	def _get_response(self, query_text, max_tokens=4000, temperature=0, return_json=False, words_in_mouth='', stream=False, stop_after_json=False, timings=None, details=None):
+		if stream:
+			return self._get_streamed_response(query_text, max_tokens=max_tokens, temperature=temperature, words_in_mouth=words_in_mouth, stop_after_json=stop_after_json, timings=timings)
 
-		response = client_instance.completions.create(
+		response = self.client.completions.create(
 			model=self.model_name,
 			max_tokens_to_sample=max_tokens,
 			prompt=f"{HUMAN_PROMPT} {query_text}{AI_PROMPT}{words_in_mouth}",
@@ -102,29 +532,273 @@ class AnthropicModel(Model):
 			temperature=temperature
 		)
 
-		client_instance.close()
-
 		out = words_in_mouth + response.completion
 
-		input_tokens = self.get_tokens(query_text)
-		output_tokens = self.get_tokens(out)
+		# text completions report no usage, so count it ourselves
+		input_tokens, output_tokens = self._count_usage(query_text, out)
 
 		return out, input_tokens, output_tokens
 
 
-	def get_tokens(self, text):
-		client_instance = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
-		num_tokens = client_instance.count_tokens(text)
-		client_instance.close()
-		return num_tokens
+	def _get_streamed_response(self, query_text, max_tokens=4000, temperature=0, words_in_mouth='', stop_after_json=False, timings=None):
+		timings = {} if timings is None else timings
+		start_time = time.perf_counter()
+
+		response = self.client.completions.create(
+			model=self.model_name,
+			max_tokens_to_sample=max_tokens,
+			prompt=f"{HUMAN_PROMPT} {query_text}{AI_PROMPT}{words_in_mouth}",
+				stop_sequences=['\n\n'], 
+			temperature=temperature,
+			stream=True
+		)
+
+		# the JSON value is opened by the words we put in Claude's mouth
+		out = words_in_mouth
+		extractor = JSONExtractor()
+		extractor.feed(words_in_mouth)
+		try:
+			for event in response:
+				text = event.completion
+				if len(text) == 0:
+					continue
+
+				timings.setdefault('time_to_first_token', time.perf_counter() - start_time)
+				out += text
+
+				if stop_after_json and extractor.feed(text):
+					timings['time_to_json'] = time.perf_counter() - start_time
+					break
+		finally:
+			response.close()
+
+		timings.setdefault('time_to_json', time.perf_counter() - start_time)
+
+		input_tokens, output_tokens = self._count_usage(query_text, out)
+
+		return out, input_tokens, output_tokens
+
+
+	def batch_request(self, custom_id, query_text, max_tokens=4000, temperature=0, words_in_mouth='', **kwargs):
+		# the message batches API has no text completions, so prefill the assistant turn instead;
+		# it must not end in whitespace, which parse_batch_result cannot restore, but JSON does not care
+		words_in_mouth = words_in_mouth or ''
+		messages = [{'role': 'user', 'content': query_text}]
+		if len(words_in_mouth.rstrip()) > 0:
+			messages.append({'role': 'assistant', 'content': words_in_mouth.rstrip()})
+
+		params = {
+			'model': self.model_name, 
+			'max_tokens': max_tokens, 
+			'temperature': temperature, 
+			'stop_sequences': ['\n\n'], 
+			'messages': messages
+		}
+
+		return {'custom_id': custom_id, 'params': params}
+
+	def parse_batch_result(self, result, request):
+		if result['result']['type'] != 'succeeded':
+			return result['custom_id'], None, None, None
+
+		# put the prefilled words back in front of the completion
+		messages = request['params']['messages']
+		out = messages[-1]['content'] if messages[-1]['role'] == 'assistant' else ''
+
+		message = result['result']['message']
+		out += ''.join(block['text'] for block in message['content'] if block['type'] == 'text')
+
+		# the API counts the messages as sent, so the offset of the report is their framing
+		input_tokens = message['usage']['input_tokens']
+		self._record_calibration([sum(self.get_tokens_batch([m['content'] for m in messages]))], [input_tokens])
+		return result['custom_id'], out, input_tokens, message['usage']['output_tokens']
+
+
+	@functools.cached_property
+	def tokenizer(self):
+		# the tokenizer ships with the SDK, so counting runs in-process
+		return self.client.get_tokenizer()
+
+	def _count_tokens(self, texts):
+		return [len(encoding.ids) for encoding in self.tokenizer.encode_batch(texts)]
+
+
+	def _record_calibration(self, estimates, exact):
+		with self._token_calibration_lock:
+			self.token_calibration.extend(zip(estimates, exact))
+		return
+
+	def calibration_report(self):
+		with self._token_calibration_lock:
+			pairs = list(self.token_calibration)
+
+		if len(pairs) == 0:
+			return None
+
+		estimates = np.array([e for e, _ in pairs], dtype=float)
+		exact = np.array([x for _, x in pairs], dtype=float)
+		errors = exact - estimates
+		rel_errors = errors / np.maximum(exact, 1)
+
+		out = {
+			'samples': len(pairs), 
+			'mean_offset': float(errors.mean()), 
+			'mean_abs_error': float(np.abs(errors).mean()), 
+			'max_abs_error': float(np.abs(errors).max()), 
+			'mean_rel_error': float(rel_errors.mean()), 
+			'max_abs_rel_error': float(np.abs(rel_errors).max())
+		}
 
+		return out
+
+
+
+class MockAPIError(Exception):
+
+	# looks enough like an SDK APIStatusError for is_retryable and retry_after
+	def __init__(self, message, status_code=500, retry_after=None):
+		super(MockAPIError, self).__init__(message)
+		self.status_code = status_code
+		headers = {'retry-after': str(retry_after)} if retry_after is not None else {}
+		self.response = httpx.Response(status_code, headers=headers)
+
+
+
+def mock_completion(query_text, rng):
+	# a schema-valid answer to whichever of our prompts `query_text` is
+	pages = [int(p) for p in re.findall(r'<PAGE (\d+)>', query_text)] or [1]
+	# the questions are in the instructions after the document, whichever the layout
+	match = re.search(r'[:.] ?\n(.*?)\n\s*\n', query_text.rsplit('</DOCUMENT>', 1)[-1], re.S)
+	questions = match.group(1).split('\n') if match is not None else ['n/a']
+
+	if '`pages` (list[int])' in query_text:
+		lines = [{'question': q, 'pages': sorted(rng.sample(pages, min(5, len(pages))))} for q in questions]
+		return '\n'.join(json.dumps(l) for l in lines)
+
+	if 'Generate ' in query_text or 'Break down this question' in query_text:
+		num = int(re.search(r'(?:Generate|into) (\d+)', query_text).group(1))
+		return json.dumps([f'{questions[0]} ({i+1:d})' for i in range(num)], indent=2)
+
+	if 'Write a question' in query_text:
+		return json.dumps({'question': 'What is the mock question?', 'answer': ['mock answer']}, indent=2)
+
+	if '`answer` (str)' not in query_text:
+		return json.dumps({'question': questions[0], 'page': rng.choice(pages)}, indent=2)
+
+	out = {'question': questions[0], 'answer': 'n/a'}
+	if '`page` (int)' in query_text:
+		out['page'] = rng.choice(pages)
+	return json.dumps(out, indent=2)
+
+
+
+class MockModel(Model):
+
+	# an offline stand-in for the API backends with lognormal latency (`latency` is the median in
+	# seconds), random server errors and 429s, and a rough word/punctuation token count
+	def __init__(self, latency=1.0, latency_sigma=0.5, error_rate=0, rate_limit_rate=0, retry_after=1, seed=0, prefix_cache_size=2**16, **kwargs):
+		super(MockModel, self).__init__(path_to_env=None, **kwargs)
+		self.model_name = 'mock'
+
+		self.latency = latency
+		self.latency_sigma = latency_sigma
+		self.error_rate = error_rate
+		self.rate_limit_rate = rate_limit_rate
+		self.retry_after = retry_after
+
+		self._rng = random.Random(seed)
+		self._rng_lock = threading.Lock()
 
+		# LRU of prompt prefix hashes, see _read_prefix_cache
+		self.prefix_cache_size = prefix_cache_size
+		self._prefix_cache = collections.OrderedDict()
+		self._prefix_cache_lock = threading.Lock()
 
-def load_model(model_cls):
+
+	def _get_response(self, query_text, max_tokens=4000, temperature=0, return_json=False, words_in_mouth=None, stream=False, stop_after_json=False, timings=None, details=None):
+		with self._rng_lock:
+			delay = self._rng.lognormvariate(np.log(self.latency), self.latency_sigma) if self.latency > 0 else 0
+			u = self._rng.random()
+			rng = random.Random(self._rng.random())
+
+		time.sleep(delay)
+
+		if u < self.rate_limit_rate:
+			raise MockAPIError('Rate limit exceeded.', status_code=429, retry_after=self.retry_after)
+		if u < self.rate_limit_rate + self.error_rate:
+			raise MockAPIError('Internal server error.', status_code=500)
+
+		out = mock_completion(query_text, rng)
+
+		# pretend the first token arrives after a tenth of the latency
+		if timings is not None:
+			timings['time_to_first_token'] = delay/10
+			timings['time_to_json'] = delay
+
+		input_tokens, output_tokens = self._count_usage(query_text, out)
+		if details is not None:
+			details['cached_input_tokens'] = self._read_prefix_cache(query_text)
+
+		return out, input_tokens, output_tokens
+
+
+	def _read_prefix_cache(self, query_text):
+		# a provider-style prompt cache over blocks of MOCK_PREFIX_BLOCK characters:
+		# returns the token count of the longest previously seen prefix, and caches this prompt's prefixes
+		h = hashlib.blake2b(digest_size=16)
+		hit = 0
+		with self._prefix_cache_lock:
+			for i in range(MOCK_PREFIX_BLOCK, len(query_text)+1, MOCK_PREFIX_BLOCK):
+				h.update(query_text[i-MOCK_PREFIX_BLOCK:i].encode('utf-8'))
+				key = h.digest()
+				if key in self._prefix_cache:
+					self._prefix_cache.move_to_end(key)
+					hit = i
+				else:
+					self._prefix_cache[key] = True
+			while len(self._prefix_cache) > self.prefix_cache_size:
+				self._prefix_cache.popitem(last=False)
+
+		return self.get_tokens(query_text[:hit]) if hit > 0 else 0
+
+
+	def _count_tokens(self, texts):
+		return [len(MOCK_TOKEN_PATTERN.findall(text)) for text in texts]
+
+
+	def complete_batch(self, requests_path, results_path):
+		# play the provider's batch endpoint on a file written by batch_request
+		with open(requests_path, 'r') as f_in, open(results_path, 'w') as f_out:
+			for l in f_in:
+				request = json.loads(l)
+				body = request['body']
+				try:
+					details = {}
+					out, input_tokens, output_tokens = self._get_response(body['messages'][-1]['content'], max_tokens=body['max_tokens'], temperature=body['temperature'], details=details)
+					usage = {'prompt_tokens': input_tokens, 'completion_tokens': output_tokens, 'prompt_tokens_details': {'cached_tokens': details['cached_input_tokens']}}
+					response = {'status_code': 200, 'body': {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': out}}], 'usage': usage}}
+				except MockAPIError as e:
+					response = {'status_code': e.status_code, 'body': {'error': {'message': str(e)}}}
+				f_out.write(json.dumps({'custom_id': request['custom_id'], 'response': response, 'error': None}) + '\n')
+		return
+
+
+
+MOCK_TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+MOCK_PREFIX_BLOCK = 4096
+
+atexit.register(Model.close_http_client)
+
+
+
+def load_model(model_cls, **kwargs):
 	if model_cls == 'openai':
-		return OpenAIModel()
+		return OpenAIModel(**kwargs)
 
 	if model_cls == 'anthropic':
-		return AnthropicModel()
+		return AnthropicModel(**kwargs)
+
+	if model_cls == 'mock':
+		return MockModel(**kwargs)
 
-	raise ValueError('model_cls must be either openai or anthropic.')
+	raise ValueError('model_cls must be either openai, anthropic or mock.')
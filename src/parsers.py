@@ -1,57 +1,88 @@
 import re
 import ast
 import json
+import functools
 import numpy as np
-from copy import deepcopy
 
 ### find a JSON inside a string
 
-def parse_single_json(text):
-	opening_pos = None
-	count = 0
-
-	for pos, char in enumerate(text):
-
-		if opening_pos is not None and char in [opening_char, closing_char]:
-			count += (1 if char == opening_char else -1)
-			if count == 0:
-				closing_pos = pos
-				D = text[opening_pos:closing_pos+1]
-				next_text = text[closing_pos+1:]
-				return D, next_text
-
-		if opening_pos is None and char in ['[', '{']:
-			opening_pos = pos
-			opening_char = char
-			closing_char = ']' if char == '[' else '}'
-			count += 1
-
-	return None, None
+# what a JSON value opens with, and the brackets counted until it closes
+OPENING_PATTERN = re.compile(r'[\[{]')
+BRACKET_PATTERNS = {'[': re.compile(r'[\[\]]'), '{': re.compile(r'[{}]')}
+
+
+class JSONExtractor(object):
+
+	# finds the top-level JSON objects and arrays in text fed to it as it arrives, by counting the brackets
+	# of the kind that opened each (so brackets inside strings count too, as they always have); `feed`
+	# returns the texts of the values that closed in the text fed, and `closed` is set once the first has
+	def __init__(self):
+		self.pattern = None
+		self.opening_char = None
+		self.count = 0
+		self.pieces = []
+		self.closed = False
+
+
+	def feed(self, text):
+		out = []
+		pos = 0
+		start = 0
+		while True:
+			if self.pattern is None:
+				match = OPENING_PATTERN.search(text, pos)
+				if match is None:
+					break
+				self.opening_char = match.group()
+				self.pattern = BRACKET_PATTERNS[self.opening_char]
+				self.count = 1
+				start = match.start()
+				pos = match.end()
+				continue
+
+			match = self.pattern.search(text, pos)
+			if match is None:
+				self.pieces.append(text[start:])
+				break
+			self.count += (1 if match.group() == self.opening_char else -1)
+			pos = match.end()
+			if self.count == 0:
+				self.pieces.append(text[start:pos])
+				out.append(''.join(self.pieces))
+				self.pieces = []
+				self.pattern = None
+				self.closed = True
+
+		return out
+
+
+def decode_json(D):
+	# JSON as the model writes it: Python literals, JSON with true/false/null, or one of the known slips
+	try:
+		return json.loads(D)
+	except:
+		pass
+	try:
+		return ast.literal_eval(D)
+	except:
+		pass
+
+	if D.startswith('[') and D.endswith(']'):
+		return ["'" + l.strip().strip(',')[1:-1] + "'" for l in D[1:-1].split('\n') if l.strip() != '']
+	elif D.startswith('{"question":  "') and '", "pages": ' in D:
+		i = len('{"question":  "')
+		j = D.find('", "pages": ')
+		D = D[:i] + D[i:j].replace('"', '\\"') + D[j:]
+		return ast.literal_eval(D)
+	elif D[D.find('"page": ')+8].isalpha():
+		D = D.replace('"page": ', '"page": "').replace('\n}', '"\n}')
+		return ast.literal_eval(D)
+
+	raise SyntaxError('The following string cannot be parsed as JSON:\n\n' + D)
 
 
 def parse_json(text):
-	Ds = []
-
-	while True:
-		D, text = parse_single_json(text)
-		if D is None:
-			break
-		try:
-			Ds.append(ast.literal_eval(D))
-		except:
-			if D.startswith('[') and D.endswith(']'):
-				D = ["'" + l.strip().strip(',')[1:-1] + "'" for l in D[1:-1].split('\n') if l.strip() != '']
-				Ds.append(D)
-			elif D.startswith('{"question":  "') and '", "pages": ' in D:
-				i = len('{"question":  "')
-				j = D.find('", "pages": ')
-				D = D[:i] + D[i:j].replace('"', '\\"') + D[j:]
-				Ds.append(ast.literal_eval(D))
-			elif D[D.find('"page": ')+8].isalpha():
-				D = D.replace('"page": ', '"page": "').replace('\n}', '"\n}')
-				Ds.append(ast.literal_eval(D))
-			else:
-				raise SyntaxError('The following string cannot be parsed as JSON:\n\n' + D)
+	Ds = [decode_json(D) for D in JSONExtractor().feed(text)]
 
 	if len(Ds) == 0:
 		return None
@@ -64,76 +95,126 @@ def parse_json(text):
 
 ### parse page XML block from document
 
-def parse_page(document, page):
-	header = f'<PAGE {page}>'
-	footer = f'</PAGE {page}>'
+PAGE_TAG_PATTERN = re.compile(r'<(/?)PAGE ([^<>]*)>')
 
-	if header not in document:
-		return ''
 
-	text = document.split(header)[1].split(footer)[0]
-	return header + text + footer
+class PageIndex(object):
 
+	# where the pages of a document are, from one pass over its page tags: for each page, the start of its
+	# first header and the end of its text (its footer, or else the next header for that page or the end of
+	# the document), so that a page is one slice however long the document is
+	def __init__(self, document):
+		self.document = document
+		self.spans = {}
+		self.headers = []
 
-def split_pages(document):
-	chunks = document.strip().split('\n\n<PAGE')
-	chunks = [chunks[0]] + ['<PAGE'+chunk for chunk in chunks[1:]]
-	return chunks
+		starts = {}
+		ends = {}
+		for match in PAGE_TAG_PATTERN.finditer(document):
+			closing, page = match.groups()
+			if closing:
+				if page in starts and page not in ends:
+					ends[page] = match.start()
+				continue
 
+			self.headers.append((match.start(), page))
+			if page not in starts:
+				starts[page] = match.start()
+			elif page not in ends:
+				ends[page] = match.start()
 
-### chunking and maximizing uniformity
+		for page, start in starts.items():
+			self.spans[page] = (start, ends.get(page, len(document)))
 
-def balance_chunks(A, B):
-	d = sum(A) - sum(B)
 
-	if d == 0:
-		return A, B
+	def page(self, page):
+		# the page's header, text and footer, or '' if it is not in the document
+		page = f'{page}'
+		if page not in self.spans:
+			return ''
+		start, end = self.spans[page]
+		return self.document[start:end] + f'</PAGE {page}>'
 
-	if d < 0:
-		B, A = balance_chunks(list(reversed(B)), list(reversed(A)))
-		return list(reversed(A)), list(reversed(B))
 
-	while abs(d - 2*A[-1]) < abs(d):
-		d -= 2*A[-1]
-		B.insert(0, A.pop())
+	def split(self):
+		# the document cut before every header that follows a blank line, and the first numbered page
+		# in each piece (None if there is none)
+		cuts = [start for start, _ in self.headers if self.document[max(0, start-2):start] == '\n\n']
+		bounds = [0] + cuts
+		pages = [self.document[i:j-2] for i, j in zip(bounds[:-1], bounds[1:])] + [self.document[bounds[-1]:]]
 
-	return A, B
+		numbers = [None]*len(pages)
+		k = 0
+		for start, page in self.headers:
+			while k+1 < len(bounds) and start >= bounds[k+1]:
+				k += 1
+			if numbers[k] is None and page.isdigit():
+				numbers[k] = int(page)
 
+		return pages, numbers
 
-def max_uniform_partition(data, chunk_size):
-	chunks = []
 
-	chunk = []
-	count = 0
-	for x in data:
-		chunk.append(x)
-		count += x
-		if count >= chunk_size:
-			chunks.append(chunk)
-			chunk = []
-			count = 0
+@functools.lru_cache(maxsize=2)
+def page_index(document):
+	# the index of a document, built once however many of its pages are asked for; only the current
+	# document and its abbreviation are looked up repeatedly, and each entry holds a whole document
+	return PageIndex(document)
 
-	if len(chunk) > 0:
-		chunks.append(chunk)
 
-	while True:
-		old_chunks = deepcopy(chunks)
-		for i in range(len(chunks)-2, -1, -1):
-			chunks[i], chunks[i+1] = balance_chunks(chunks[i], chunks[i+1])
-		if old_chunks == chunks:
-			break
+def parse_page(document, page):
+	return page_index(document).page(page)
 
-	return chunks
 
+def split_pages(document):
+	pages, _ = page_index(document.strip()).split()
+	return pages
+
+
+### chunking and maximizing uniformity
 
-def chunk_document(document, chunk_size, token_counter):
+def partition(counts, chunk_size=None, num_chunks=None):
+	# splits `counts` into at most `num_chunks` contiguous chunks whose largest total is as small as it can be,
+	# by a binary search on that total with a greedy check over the prefix sums; by default there are as
+	# many chunks as cutting greedily after the page that reaches `chunk_size` makes.
+	# returns the index at which each chunk starts, followed by len(counts)
+	cumsum = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+	n = len(counts)
+	if n == 0:
+		return [0]
+
+	if num_chunks is None:
+		num_chunks = 0
+		start = 0
+		while start < n:
+			start = max(start+1, int(np.searchsorted(cumsum, cumsum[start] + chunk_size, side='left')))
+			num_chunks += 1
+
+	def cuts(bound):
+		# the greedy chunks with totals of at most `bound`, up to `num_chunks` of them
+		starts = [0]
+		while starts[-1] < n and len(starts) <= num_chunks:
+			starts.append(int(np.searchsorted(cumsum, cumsum[starts[-1]] + bound, side='right')) - 1)
+		return starts
+
+	# the smallest bound within which `num_chunks` chunks cover every page
+	lo = int(np.max(counts))
+	hi = int(cumsum[-1])
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if cuts(mid)[-1] == n:
+			hi = mid
+		else:
+			lo = mid + 1
+
+	return cuts(lo)
+
+
+def chunk_document(document, chunk_size, get_tokens_batch, page_tokens=None):
+	# `page_tokens` are the token counts of the pages, as split by `split_pages`, if they are known already
 	pages = split_pages(document)
-	pages = [p+'\n\n' for p in pages]
-	counts = [token_counter(p) for p in pages]
+	counts = page_tokens if page_tokens is not None else get_tokens_batch(pages)
 
-	chunked_counts = max_uniform_partition(counts, chunk_size)
-	page_counts = np.array([len(chunk) for chunk in chunked_counts])
-	idxs = np.insert(np.cumsum(page_counts), 0, 0)
-	chunks = [''.join(pages[i:j]).strip() for i, j in zip(idxs[:-1], idxs[1:])]
+	starts = partition(counts, chunk_size=chunk_size)
+	chunks = ['\n\n'.join(pages[i:j]).strip() for i, j in zip(starts[:-1], starts[1:])]
 
 	return chunks
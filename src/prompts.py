@@ -1,9 +1,144 @@
-import re
-from .parsers import split_pages
+import functools
+import numpy as np
+from .parsers import page_index, split_pages
+
+# 'instructions_first' frames the document with the instructions before and after it, as in our experiments;
+# 'document_first' puts the document ahead of everything question-specific, so that prompts over the same
+# document share a prefix that the provider can cache, and only repeats the instructions after it
+LAYOUTS = ['instructions_first', 'document_first']
+
+### Prompts with their token counts
+
+# where the document goes in the templates below
+DOCUMENT = '\x00DOCUMENT\x00'
+
+# characters on either side of a boundary between parts that are tokenized to correct for it
+BOUNDARY_WINDOW = 16
+
+
+class Prompt(str):
+
+	# a prompt assembled from parts, e.g. the pages of its document, whose `tokens` are theirs (the ones not
+	# given are counted once asked for) plus, at each boundary, the difference the few characters around it
+	# make when tokenized together and apart, which is exact for tokenizers that split text into words first
+	def __new__(cls, parts, get_tokens_batch, part_tokens=None):
+		prompt = super(Prompt, cls).__new__(cls, ''.join(parts))
+		prompt.parts = parts
+		prompt.part_tokens = part_tokens if part_tokens is not None else [None]*len(parts)
+		prompt.get_tokens_batch = get_tokens_batch
+		return prompt
+
+
+	def __reduce__(self):
+		# the parts and the tokenizer stay behind, e.g. when a prompt is sent to another process
+		return (str, (str(self),))
+
+
+	@classmethod
+	def from_template(cls, template, document_parts, get_tokens_batch, document_tokens=None):
+		head, _, tail = template.partition(DOCUMENT)
+		document_tokens = document_tokens if document_tokens is not None else [None]*len(document_parts)
+		return cls([head] + document_parts + [tail], get_tokens_batch, part_tokens=[None] + document_tokens + [None])
+
+
+	@functools.cached_property
+	def tokens(self):
+		counts = list(self.part_tokens)
+		missing = [i for i, count in enumerate(counts) if count is None and len(self.parts[i]) > 0]
+		for i, count in zip(missing, self.get_tokens_batch([self.parts[i] for i in missing])):
+			counts[i] = count
+
+		ends = np.cumsum([len(part) for part in self.parts])
+		boundaries = sorted(set(int(end) for end in ends[:-1] if 0 < end < len(self)))
+		windows = []
+		for b in boundaries:
+			left = self[max(0, b-BOUNDARY_WINDOW):b]
+			right = self[b:b+BOUNDARY_WINDOW]
+			windows.extend([left + right, left, right])
+		window_tokens = self.get_tokens_batch(windows)
+		correction = sum(window_tokens[i] - window_tokens[i+1] - window_tokens[i+2] for i in range(0, len(windows), 3))
+
+		return int(sum(count for count, part in zip(counts, self.parts) if len(part) > 0) + correction)
+
+
+def document_parts(document, page_tokens=None):
+	# the document as its pages and the blank lines between them, with the pages' token counts if known
+	if document != document.strip():
+		return [document], None
+	parts = []
+	for page in split_pages(document):
+		parts.extend([page, '\n\n'])
+	tokens = [None]*len(parts[:-1]) if page_tokens is None \
+		else [t for count in page_tokens for t in [count, None]][:-1]
+	return parts[:-1], tokens
+
+
+### Reprompting
+
+def reprompt_parts(pages, reprompt, page_tokens=None, repeat_interval=10000, repeat_before_pages=None, repeat_at_beginning=False, page_numbers=None):
+	# the document from its pages (as split by `split_pages`) with `reprompt` after every page at which the
+	# token count since the last reprompt reaches `repeat_interval`, or at the beginning as many times instead,
+	# or before the pages numbered in `repeat_before_pages`, which needs the `page_numbers` of the pages
+	# (as from `PageIndex.split`) instead of their token counts.
+	# returns the parts of the document and their token counts where known, as for `Prompt`
+	if repeat_before_pages is not None:
+		repeat_before_pages = set(repeat_before_pages)
+		before = [i for i, number in enumerate(page_numbers) if number in repeat_before_pages]
+		after = []
+	else:
+		# each reprompt goes after the first page at which the running total passes the last one's by the interval
+		cumsum = np.cumsum(page_tokens)
+		before = []
+		after = []
+		start = 0
+		base = 0
+		while start < len(cumsum):
+			i = start + int(np.searchsorted(cumsum[start:], base + repeat_interval))
+			if i == len(cumsum):
+				break
+			after.append(i)
+			start = i + 1
+			base = cumsum[i]
+
+	if repeat_at_beginning:
+		parts = [reprompt]*len(after)
+		after = []
+	else:
+		parts = []
+	before = set(before)
+	after = set(after)
+
+	part_tokens = [None]*len(parts)
+	for i, page in enumerate(pages):
+		if i in before:
+			parts.append(reprompt)
+			part_tokens.append(None)
+		parts.extend([page, '\n\n'])
+		part_tokens.extend([page_tokens[i] if page_tokens is not None else None, None])
+		if i in after:
+			parts.append(reprompt)
+			part_tokens.append(None)
+
+	return parts, part_tokens
+
 
 ### Simple Prompting/Reprompting
 
-def get_single_page(question, document):	
+def get_single_page(question, document, layout='instructions_first'):
+	if layout == 'document_first':
+		return f'''<DOCUMENT>
+{document}
+</DOCUMENT>
+
+<INSTRUCTIONS>
+Above is a document that is separated into page numbers. Identify the page number in the document that is most relevant to answering the following question: 
+{question}
+
+Return your answer in JSON format with the following keys: 
+`question` (str): the question being asked
+`page` (int): the most relevant page number to the question, or 'n/a' if no page is relevant.
+</INSTRUCTIONS>'''
+
 	return f'''<INSTRUCTIONS>
 Below is a document that is separated into page numbers. Identify the page number in the document that is most relevant to answering the following question: 
 {question}
@@ -27,12 +162,12 @@ Return your answer in JSON format with the following keys:
 </INSTRUCTIONS>'''
 
 
-def get_answer(question, document, get_tokens, repeat_prompt=False, repeat_interval=10000, repeat_before_pages=None, repeat_at_beginning=False, repeat_tag_only=False, return_page=False, return_page_only=False):
+def get_answer(question, document, get_tokens_batch, repeat_prompt=False, repeat_interval=10000, repeat_before_pages=None, repeat_at_beginning=False, repeat_tag_only=False, return_page=False, return_page_only=False, layout='instructions_first', page_tokens=None):
 	if repeat_before_pages is not None:
 		repeat_prompt = True
 
 	if return_page_only:
-		return get_single_page(question, document)
+		return get_single_page(question, document, layout=layout)
 
 	# if return_page is on, include additional JSON key in prompt
 	return_page_prompt = f'''
@@ -56,29 +191,28 @@ Return your answer in JSON format with the following keys:
 </INSTRUCTIONS_REMINDER>
 
 '''
-		total_l = 0
-		document_ = ''
-		chunks = split_pages(document)
-		for chunk in chunks:
-			if repeat_before_pages is not None:
-				page_num = int( re.search(r'<PAGE (\d+)>', chunk).groups(0)[0] )
-				if page_num in repeat_before_pages:
-					document_ += reprompt
-				document_ += chunk + '\n\n'
-				continue
-			document_ += chunk + '\n\n'
-			l = get_tokens(chunk)
-			total_l += l
-			if total_l >= repeat_interval:
-				total_l = 0
-				if repeat_at_beginning:
-					document_ = reprompt + document_
-				else:
-					document_ += reprompt
-
-		document = document_
-	
-	return f'''<INSTRUCTIONS>
+		pages, page_numbers = page_index(document.strip()).split()
+		if page_tokens is None and repeat_before_pages is None:
+			page_tokens = get_tokens_batch(pages)
+		parts, part_tokens = reprompt_parts(pages, reprompt, page_tokens=page_tokens, repeat_interval=repeat_interval, repeat_before_pages=repeat_before_pages, repeat_at_beginning=repeat_at_beginning, page_numbers=page_numbers)
+	else:
+		parts, part_tokens = document_parts(document, page_tokens=page_tokens)
+
+	if layout == 'document_first':
+		template = f'''<DOCUMENT>
+{DOCUMENT}
+</DOCUMENT>
+
+<INSTRUCTIONS>
+Answer the following question based on the above document and no additional extraneous information:
+{question}
+
+Return your answer in JSON format with the following keys: 
+`question` (str): the question being answered
+`answer` (str): the answer to the question, or 'n/a' if the answer does not appear in the document{return_page_prompt}
+</INSTRUCTIONS>'''
+	else:
+		template = f'''<INSTRUCTIONS>
 Answer the following question based on the document provided and no additional extraneous information:
 {question}
 
@@ -88,7 +222,7 @@ Return your answer in JSON format with the following keys:
 </INSTRUCTIONS>	
 
 <DOCUMENT>
-{document}
+{DOCUMENT}
 </DOCUMENT>
 
 <INSTRUCTIONS>
@@ -100,6 +234,8 @@ Return your answer in JSON format with the following keys:
 `answer` (str): the answer to the question, or 'n/a' if the answer does not appear in the document{return_page_prompt}
 </INSTRUCTIONS>'''
 
+	return Prompt.from_template(template, parts, get_tokens_batch, document_tokens=part_tokens)
+
 
 ### Rephrasing + Reprompting + Abbreviation
 
@@ -121,19 +257,13 @@ Break down this question into {num:d} subquestions. Return your answer as a Pyth
 </INSTRUCTIONS>'''
 
 
-def get_page_numbers_only_single_question(question, document, get_tokens, repeat_prompt=False, repeat_interval=10000, num_pages=5):
+def get_page_numbers_only_single_question(question, document, get_tokens_batch, repeat_prompt=False, repeat_interval=10000, num_pages=5, layout='instructions_first', page_tokens=None):
 		
 	if repeat_prompt:
-		total_l = 0
-		document_ = ''
-		chunks = split_pages(document)
-		for chunk in chunks:
-			document_ += chunk + '\n\n'
-			l = get_tokens(chunk)
-			total_l += l
-			if total_l >= repeat_interval:
-				total_l = 0
-				document_ += f'''<INSTRUCTIONS_REMINDER>
+		pages = split_pages(document)
+		if page_tokens is None:
+			page_tokens = get_tokens_batch(pages)
+		reprompt = f'''<INSTRUCTIONS_REMINDER>
 Remember, your task is to identify up to {num_pages:d} page numbers in the document that are most relevant to the following question: 
 {question}
 
@@ -143,9 +273,25 @@ Return your answer in JSON format with the following keys:
 </INSTRUCTIONS_REMINDER>
 
 '''
-		document = document_
-	
-	return f'''<INSTRUCTIONS>
+		parts, part_tokens = reprompt_parts(pages, reprompt, page_tokens=page_tokens, repeat_interval=repeat_interval)
+	else:
+		parts, part_tokens = document_parts(document, page_tokens=page_tokens)
+
+	if layout == 'document_first':
+		template = f'''<DOCUMENT>
+{DOCUMENT}
+</DOCUMENT>
+
+<INSTRUCTIONS>
+Above is a document that is separated into page numbers. Identify up to {num_pages:d} page numbers in the document that are most relevant to the following question: 
+{question}
+
+Return your answer in JSON format with the following keys: 
+`question` (str): the question being answered
+`pages` (list[int]): up to {num_pages:d} page numbers of the document that are most relevant to the question.
+</INSTRUCTIONS>'''
+	else:
+		template = f'''<INSTRUCTIONS>
 Below is a document that is separated into page numbers. Identify up to {num_pages:d} page numbers in the document that are most relevant to the following question: 
 {question}
 	
@@ -155,7 +301,7 @@ Return your answer in JSON format with the following keys:
 </INSTRUCTIONS>
 	
 <DOCUMENT>
-{document}
+{DOCUMENT}
 </DOCUMENT>
 
 <INSTRUCTIONS>
@@ -167,25 +313,21 @@ Return your answer in JSON format with the following keys:
 `pages` (list[int]): up to {num_pages:d} page numbers of the document that are most relevant to the question.
 </INSTRUCTIONS>'''
 
+	return Prompt.from_template(template, parts, get_tokens_batch, document_tokens=part_tokens)
+
 
-def get_page_numbers_only(questions, document, get_tokens, repeat_prompt=False, repeat_interval=10000, num_pages=5):
+def get_page_numbers_only(questions, document, get_tokens_batch, repeat_prompt=False, repeat_interval=10000, num_pages=5, layout='instructions_first', page_tokens=None):
 	if len(questions) == 1:
 		question = questions[0]
-		return get_page_numbers_only_single_question(question, document, get_tokens, repeat_prompt=repeat_prompt, repeat_interval=repeat_interval, num_pages=num_pages)
+		return get_page_numbers_only_single_question(question, document, get_tokens_batch, repeat_prompt=repeat_prompt, repeat_interval=repeat_interval, num_pages=num_pages, layout=layout, page_tokens=page_tokens)
 	
 	questions = '\n'.join(questions)
 	
 	if repeat_prompt:
-		total_l = 0
-		document_ = ''
-		chunks = split_pages(document)
-		for chunk in chunks:
-			document_ += chunk + '\n\n'
-			l = get_tokens(chunk)
-			total_l += l
-			if total_l >= repeat_interval:
-				total_l = 0
-				document_ += f'''<INSTRUCTIONS_REMINDER>
+		pages = split_pages(document)
+		if page_tokens is None:
+			page_tokens = get_tokens_batch(pages)
+		reprompt = f'''<INSTRUCTIONS_REMINDER>
 Remember, for each of the following questions, your task is to identify up to {num_pages:d} page numbers in the document that are most relevant to that question: 
 {questions}
 
@@ -196,9 +338,26 @@ Make sure to include every question in the JSONL.
 </INSTRUCTIONS_REMINDER>
 
 '''
-		document = document_
-	
-	return f'''<INSTRUCTIONS>
+		parts, part_tokens = reprompt_parts(pages, reprompt, page_tokens=page_tokens, repeat_interval=repeat_interval)
+	else:
+		parts, part_tokens = document_parts(document, page_tokens=page_tokens)
+
+	if layout == 'document_first':
+		template = f'''<DOCUMENT>
+{DOCUMENT}
+</DOCUMENT>
+
+<INSTRUCTIONS>
+Above is a document that is separated into page numbers. For each of the following questions, identify up to {num_pages:d} page numbers in the document that are most relevant to that question: 
+{questions}
+
+Return your answers in JSONL format with one question per line. Each line should have the following keys: 
+`question` (str): the question being answered
+`pages` (list[int]): up to {num_pages:d} page numbers of the document that are most relevant to the question.
+Make sure to include every question in the JSONL.
+</INSTRUCTIONS>'''
+	else:
+		template = f'''<INSTRUCTIONS>
 Below is a document that is separated into page numbers. For each of the following questions, identify up to {num_pages:d} page numbers in the document that are most relevant to that question: 
 {questions}
 	
@@ -209,7 +368,7 @@ Make sure to include every question in the JSONL.
 </INSTRUCTIONS>
 	
 <DOCUMENT>
-{document}
+{DOCUMENT}
 </DOCUMENT>
 
 <INSTRUCTIONS>
@@ -221,3 +380,5 @@ Return your answers in JSONL format with one question per line. Each line should
 `pages` (list[int]): up to {num_pages:d} page numbers of the document that are most relevant to the question.
 Make sure to include every question in the JSONL.
 </INSTRUCTIONS>'''
+
+	return Prompt.from_template(template, parts, get_tokens_batch, document_tokens=part_tokens)
@@ -1,16 +1,23 @@
 import os
 import json
+import asyncio
 import pathlib
 import time
 from copy import deepcopy
-from .parsers import chunk_document, parse_page, split_pages
+from concurrent.futures import ThreadPoolExecutor
+from .parsers import chunk_document, page_index, split_pages
 from .prompts import *
 
-def run_page_numbers_only(questions, document, model, repeat_prompt=False, repeat_interval=10000):
+def page_numbers_only_request(questions, document, model, repeat_prompt=False, repeat_interval=10000, usage=None, layout='instructions_first', page_tokens=None):
 	words_in_mouth = '\n{"question": '
 
-	prompt = get_page_numbers_only(questions, document, model.get_tokens, repeat_prompt=repeat_prompt, repeat_interval=repeat_interval)
-	response = model.get_response(prompt, return_json=True, words_in_mouth=words_in_mouth)
+	prompt = get_page_numbers_only(questions, document, model.get_tokens_batch, repeat_prompt=repeat_prompt, repeat_interval=repeat_interval, layout=layout, page_tokens=page_tokens)
+
+	# with several questions the answer is JSONL, so we cannot stop at the first closed object
+	return {'query_text': prompt, 'return_json': True, 'words_in_mouth': words_in_mouth, 'usage': usage, 'stop_after_json': len(questions) == 1}
+
+
+def page_numbers_only_output(questions, response):
 	if response is None:
 		pages = []
 	elif type(response) == dict:
@@ -28,7 +35,16 @@ def run_page_numbers_only(questions, document, model, repeat_prompt=False, repea
 	return out
 
 
-def run(model, dataset, question_id=0, total_context=10000, answer_position=0, repeat_prompt=False, repeat_interval=10000, repeat_at_beginning=False, repeat_before_answer=False, repeat_tag_only=False, return_page=False, return_page_only=False, rephrase_count=0, do_abbreviate=False, do_chunking=False, chunk_size=10000, output_path=None, overwrite=False):
+def run_page_numbers_only(questions, document, model, repeat_prompt=False, repeat_interval=10000, layout='instructions_first'):
+	request = page_numbers_only_request(questions, document, model, repeat_prompt=repeat_prompt, repeat_interval=repeat_interval, layout=layout)
+	response = model.get_response(**request)
+	return page_numbers_only_output(questions, response)
+
+
+def run_steps(model, dataset, question_id=0, total_context=10000, answer_position=0, repeat_prompt=False, repeat_interval=10000, repeat_at_beginning=False, repeat_before_answer=False, repeat_tag_only=False, return_page=False, return_page_only=False, rephrase_count=0, do_abbreviate=False, do_chunking=False, chunk_size=10000, layout='instructions_first', document_store=None, output_path=None, overwrite=False):
+	# generator behind `run` and `run_async`: yields lists of `model.get_response` kwargs
+	# and is sent back the list of responses, in the same order
+
 	# check args
 	if repeat_at_beginning and repeat_before_answer:
 		raise ValueError('repeat_at_beginning and repeat_before_answer are incompatible.')
@@ -36,19 +52,32 @@ def run(model, dataset, question_id=0, total_context=10000, answer_position=0, r
 		assert do_abbreviate, 'Chunking requires abbreviation to be on.'
 	if repeat_at_beginning or repeat_tag_only:
 		assert do_abbreviate == False, 'repeat_at_beginning and repeat_tag_only are not compatible with do_abbreviate.'
+	if layout not in LAYOUTS:
+		raise ValueError(f'layout must be one of {LAYOUTS}.')
+	if document_store is not None and document_store.model_name != model.model_name:
+		raise ValueError(f'The document store was measured with {document_store.model_name}, not {model.model_name}.')
+	if document_store is not None and document_store.dataset_source != dataset.source:
+		raise ValueError(f'The document store was rendered from other data than {document_store.dataset_name} now has.')
 
 	# quit if path exists
-	if (not overwrite) and os.path.exists(output_path):
+	if (not overwrite) and output_path is not None and os.path.exists(output_path):
 		return None
 
 	# get start time
 	start_time = time.time()
 
-	# reset accumulated token count
-	model.reset_tokens()
+	# token count of this run only, so concurrent runs can share a model
+	usage = {'input_tokens': 0, 'output_tokens': 0, 'cached_input_tokens': 0}
 
-	# load data example
-	example = dataset.get(question_id=question_id, answer_position=answer_position, total_context=total_context, get_tokens=model.get_tokens)
+	# load data example, from the materialized documents if it is there (see src/documents.py),
+	# which also saves tokenizing its pages again for reprompting
+	page_tokens = None
+	if document_store is not None and (question_id, answer_position, total_context) in document_store:
+		example = document_store.get(question_id=question_id, answer_position=answer_position, total_context=total_context)
+		page_tokens = document_store.page_tokens(question_id=question_id, answer_position=answer_position, total_context=total_context)
+	else:
+		# `dataset.get` is cached and runs add their results to the example, so take a copy
+		example = dict(dataset.get(question_id=question_id, answer_position=answer_position, total_context=total_context, get_tokens_batch=model.get_tokens_batch))
 	question = example['question']
 	document = example['document']
 
@@ -61,25 +90,26 @@ def run(model, dataset, question_id=0, total_context=10000, answer_position=0, r
 		# get a bunch of variants of the original question
 		if rephrase_count > 0:
 			words_in_mouth = '\n[\n'
-			prompt = query_expansion(question, num=rephrase_count)
-			questions_ = model.get_response(prompt, return_json=True, words_in_mouth=words_in_mouth)
-			questions.extend(questions_)
-
-			prompt = query_splitter(question, num=rephrase_count)
-			questions_ = model.get_response(prompt, return_json=True, words_in_mouth=words_in_mouth)
-			questions.extend(questions_)
+			prompts = [query_expansion(question, num=rephrase_count), query_splitter(question, num=rephrase_count)]
+			variants, subquestions = yield [{'query_text': prompt, 'return_json': True, 'words_in_mouth': words_in_mouth, 'usage': usage, 'stop_after_json': True} for prompt in prompts]
+			questions.extend(variants)
+			questions.extend(subquestions)
 
 		# get the most relevant pages from the context using the question variants
 		if do_chunking:
-			chunks = chunk_document(document, chunk_size, model.get_tokens)
-			example['do_abbreviate'] = [run_page_numbers_only(questions, chunk, model, repeat_prompt=repeat_prompt, repeat_interval=repeat_interval) for chunk in chunks]
+			chunks = chunk_document(document, chunk_size, model.get_tokens_batch, page_tokens=page_tokens)
+			responses = yield [page_numbers_only_request(questions, chunk, model, repeat_prompt=repeat_prompt, repeat_interval=repeat_interval, usage=usage, layout=layout) for chunk in chunks]
+			example['do_abbreviate'] = [page_numbers_only_output(questions, response) for response in responses]
 			pages = sorted(list(set([p for chunk in example['do_abbreviate'] for p in deepcopy(chunk['pages'])])))
 		else:
-			example['do_abbreviate'] = run_page_numbers_only(questions, document, model, repeat_prompt=repeat_prompt, repeat_interval=repeat_interval)
+			response, = yield [page_numbers_only_request(questions, document, model, repeat_prompt=repeat_prompt, repeat_interval=repeat_interval, usage=usage, layout=layout, page_tokens=page_tokens)]
+			example['do_abbreviate'] = page_numbers_only_output(questions, response)
 			pages = deepcopy(example['do_abbreviate']['pages'])
 
-		# create document from extracted pages
-		document = '\n\n'.join( filter(lambda p: len(p)>0, [parse_page(document, p) for p in pages]) )
+		# create document from extracted pages, with an index of its own so concurrent runs cannot evict it between pages
+		index = page_index(document)
+		document = '\n\n'.join( filter(lambda p: len(p)>0, [index.page(p) for p in pages]) )
+		page_tokens = None
 
 	# put words in Claude's mouth
 	question_escaped_quotes = question.replace('"', '\\"')
@@ -100,13 +130,17 @@ def run(model, dataset, question_id=0, total_context=10000, answer_position=0, r
 		repeat_before_pages = None
 
 	# run the prompt
-	prompt = get_answer(question, document, model.get_tokens, repeat_prompt=repeat_prompt, repeat_interval=repeat_interval, repeat_before_pages=repeat_before_pages, repeat_at_beginning=repeat_at_beginning, repeat_tag_only=repeat_tag_only, return_page=return_page, return_page_only=return_page_only)
+	prompt = get_answer(question, document, model.get_tokens_batch, repeat_prompt=repeat_prompt, repeat_interval=repeat_interval, repeat_before_pages=repeat_before_pages, repeat_at_beginning=repeat_at_beginning, repeat_tag_only=repeat_tag_only, return_page=return_page, return_page_only=return_page_only, layout=layout, page_tokens=page_tokens)
 	example['prompt'] = prompt
-	example['response'] = model.get_response(prompt, return_json=True, words_in_mouth=words_in_mouth)
+	timings = {}
+	example['response'], = yield [{'query_text': prompt, 'return_json': True, 'words_in_mouth': words_in_mouth, 'usage': usage, 'stop_after_json': True, 'timings': timings}]
+	example['time_to_first_token'] = timings.get('time_to_first_token')
+	example['time_to_json'] = timings.get('time_to_json')
 
 	# record token count
-	example['input_tokens'] = model.input_tokens
-	example['output_tokens'] = model.output_tokens
+	example['input_tokens'] = usage['input_tokens']
+	example['output_tokens'] = usage['output_tokens']
+	example['cached_input_tokens'] = usage['cached_input_tokens']
 
 	# record time
 	end_time = time.time()
@@ -119,5 +153,52 @@ def run(model, dataset, question_id=0, total_context=10000, answer_position=0, r
 		pathlib.Path(output_path).parent.mkdir(parents=True, exist_ok=True)
 		with open(output_path, 'w') as f:
 			json.dump(output_dict, f, indent=2)
-		
+
 	return output_dict
+
+
+def advance(steps, responses=None):
+	# returns (requests, None) for the next step, or (None, output) once the run is done
+	try:
+		return steps.send(responses), None
+	except StopIteration as e:
+		return None, e.value
+
+
+def run(model, dataset, batch_file=None, max_concurrency=None, **kwargs):
+	# with a BatchWriter `batch_file`, requests not yet in the model's cache are written
+	# to it instead of being sent, and the run stops there until the results are ingested;
+	# the requests of a step (e.g. one per chunk) are sent concurrently, up to `max_concurrency`
+	# (by default the model's) at a time
+	max_concurrency = max_concurrency or model.max_concurrency
+
+	# reset accumulated token count
+	model.reset_tokens()
+
+	steps = run_steps(model, dataset, **kwargs)
+	requests, out = advance(steps)
+	while requests is not None:
+		if batch_file is not None and batch_file.add_missing(model, requests) > 0:
+			steps.close()
+			return None
+		if len(requests) == 1 or max_concurrency == 1:
+			responses = [model.get_response(**request) for request in requests]
+		else:
+			# a pool of our own, since runs may themselves be running on the model's executor
+			with ThreadPoolExecutor(max_workers=min(max_concurrency, len(requests))) as executor:
+				responses = list(executor.map(lambda request: model.get_response(**request), requests))
+		requests, out = advance(steps, responses)
+
+	return out
+
+
+async def run_async(model, dataset, **kwargs):
+	# same as `run`, but the requests of each step are awaited concurrently,
+	# and the CPU-bound steps are kept off the event loop
+	steps = run_steps(model, dataset, **kwargs)
+	requests, out = await asyncio.to_thread(advance, steps)
+	while requests is not None:
+		responses = await asyncio.gather(*[model.get_response_async(**request) for request in requests])
+		requests, out = await asyncio.to_thread(advance, steps, list(responses))
+
+	return out
@@ -0,0 +1,84 @@
+import os
+import json
+import shutil
+import pathlib
+import numpy as np
+
+### record store
+# the records of a dataset as one JSON line each, with a byte-offset index, built once from the source
+# file and memory-mapped, so opening a dataset parses nothing and a run only parses the records it reads
+
+
+def source_id(path):
+	# identifies the version of a data file that a store or arena was built from
+	stat = os.stat(path)
+	return f'{os.path.abspath(path)}:{stat.st_size:d}:{stat.st_mtime_ns:d}'
+
+
+def is_built(path, source):
+	meta_path = os.path.join(path, 'meta.json')
+	if not os.path.exists(meta_path):
+		return False
+	with open(meta_path, 'r') as f:
+		return json.load(f)['source'] == source
+
+
+def start_build(path):
+	# builds go to a temporary directory that finish_build moves into place,
+	# so concurrent builders never leave a partial one behind
+	tmp_path = f'{path}.{os.getpid():d}.tmp'
+	pathlib.Path(tmp_path).mkdir(parents=True, exist_ok=True)
+	return tmp_path
+
+
+def finish_build(tmp_path, path, source):
+	with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+		json.dump({'source': source}, f)
+
+	if os.path.exists(path) and not is_built(path, source):
+		shutil.rmtree(path)
+	try:
+		os.rename(tmp_path, path)
+	except OSError:
+		# someone else finished first
+		shutil.rmtree(tmp_path)
+	return
+
+
+
+class RecordStore(object):
+
+	def __init__(self, path):
+		self.path = path
+		self.offsets = np.load(os.path.join(self.path, 'offsets.npy'), mmap_mode='r')
+		self.buffer = np.memmap(os.path.join(self.path, 'records.jsonl'), dtype=np.uint8, mode='r') if self.offsets[-1] > 0 \
+			else np.zeros(0, dtype=np.uint8)
+
+
+	@classmethod
+	def build(cls, path, records, source=None):
+		tmp_path = start_build(path)
+
+		offsets = [0]
+		with open(os.path.join(tmp_path, 'records.jsonl'), 'wb') as f:
+			for record in records:
+				data = (json.dumps(record) + '\n').encode('utf-8')
+				f.write(data)
+				offsets.append(offsets[-1] + len(data))
+		np.save(os.path.join(tmp_path, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+
+		finish_build(tmp_path, path, source)
+		return cls(path)
+
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, i):
+		if not 0 <= i < len(self):
+			raise IndexError(f'Record {i:d} is out of range.')
+		return json.loads(bytes(self.buffer[self.offsets[i]:self.offsets[i+1]]))
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import pathlib
+import threading
+import collections
+import numpy as np
+
+
+class Telemetry(object):
+
+	# aggregates per-request records from Model and periodically writes a snapshot to `path`,
+	# in Prometheus text format if it ends in .prom and as JSON otherwise;
+	# prices are in dollars per million tokens (by default INPUT_PRICE and OUTPUT_PRICE from the environment),
+	# and rates and percentiles are over the last `window` seconds
+	def __init__(self, path='results/telemetry.json', interval=10, window=60, total=None, input_price=None, output_price=None):
+		self.path = path
+		self.interval = interval
+		self.window = window
+		self.total = total
+		self.input_price = input_price
+		self.output_price = output_price
+
+		self.start_time = time.time()
+		self.completed = 0
+		self.totals = {'requests': 0, 'errors': 0, 'retries': 0, 'input_tokens': 0, 'output_tokens': 0, 'cached_input_tokens': 0}
+		self.records = collections.deque()
+		self._lock = threading.Lock()
+
+		self._stop = threading.Event()
+		self._thread = None
+
+
+	def record(self, latency, input_tokens=0, output_tokens=0, retries=0, error=None, cached_input_tokens=0):
+		now = time.time()
+		with self._lock:
+			self.records.append((now, latency, input_tokens, output_tokens, error is not None))
+			self.totals['requests'] += 1
+			self.totals['errors'] += int(error is not None)
+			self.totals['retries'] += retries
+			self.totals['input_tokens'] += input_tokens
+			self.totals['output_tokens'] += output_tokens
+			self.totals['cached_input_tokens'] += cached_input_tokens
+		return
+
+
+	def advance(self, n=1):
+		# mark `n` more runs of the grid as done
+		with self._lock:
+			self.completed += n
+		return
+
+
+	def snapshot(self):
+		now = time.time()
+		with self._lock:
+			while len(self.records) > 0 and self.records[0][0] < now - self.window:
+				self.records.popleft()
+			records = list(self.records)
+			totals = dict(self.totals)
+			completed = self.completed
+
+		# the env file is only loaded with the model, so read the prices late
+		input_price = self.input_price if self.input_price is not None else float(os.getenv('INPUT_PRICE', 0))
+		output_price = self.output_price if self.output_price is not None else float(os.getenv('OUTPUT_PRICE', 0))
+
+		elapsed = now - self.start_time
+		span = min(self.window, elapsed) or 1
+		latencies = np.array([r[1] for r in records])
+
+		out = {
+			'time': now,
+			'elapsed_seconds': elapsed,
+			'requests_per_second': len(records)/span,
+			'tokens_per_minute': 60*sum(r[2] + r[3] for r in records)/span,
+			'latency_p50': float(np.percentile(latencies, 50)) if len(records) > 0 else None,
+			'latency_p95': float(np.percentile(latencies, 95)) if len(records) > 0 else None,
+			'latency_p99': float(np.percentile(latencies, 99)) if len(records) > 0 else None,
+			'error_rate': sum(r[4] for r in records)/len(records) if len(records) > 0 else None,
+			'cost': (input_price*totals['input_tokens'] + output_price*totals['output_tokens'])/1e6,
+			'completed': completed,
+			'total': self.total,
+			'eta_seconds': elapsed/completed*(self.total - completed) if (self.total is not None and completed > 0) else None
+		}
+		out.update({f'{k}_total': v for k, v in totals.items()})
+
+		return out
+
+
+	def write(self):
+		snapshot = self.snapshot()
+
+		if self.path.endswith('.prom'):
+			lines = []
+			for k, v in snapshot.items():
+				if v is None:
+					continue
+				if k.startswith('latency_'):
+					lines.append(f'rr_latency_seconds{{quantile="0.{k[9:]}"}} {v}')
+				else:
+					lines.append(f'rr_{k} {v}')
+			text = '\n'.join(lines) + '\n'
+		else:
+			text = json.dumps(snapshot, indent=2)
+
+		# write atomically so that readers never see a partial file
+		pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+		with open(self.path + '.tmp', 'w') as f:
+			f.write(text)
+		os.replace(self.path + '.tmp', self.path)
+
+		return snapshot
+
+
+	def start(self):
+		def loop():
+			while not self._stop.wait(self.interval):
+				self.write()
+		self._thread = threading.Thread(target=loop, daemon=True)
+		self._thread.start()
+		return self
+
+
+	def stop(self):
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+		return self.write()